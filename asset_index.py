@@ -0,0 +1,223 @@
+import hashlib
+import os
+import sqlite3
+import threading
+
+INDEX_FILENAME = "index.db"
+ACTIVE_PATH = "Active/"
+NORMALIZED_PATH = "Normalized/"
+
+# perceptual hashes are 64 bit difference hashes, stored as 8 indexed bands of 8 bits.
+# two hashes within 7 bits of each other always share a band, so only images sharing a band need comparing
+PHASH_BANDS = 8
+NEAR_DUPLICATE_DISTANCE = 6
+
+# open indexes by directory, shared by every thread of the process
+INDEXES = {}
+INDEXES_LOCK = threading.Lock()
+
+
+def content_hash(data) -> str:
+    return hashlib.sha1(data).hexdigest()
+
+
+def perceptual_hash(image) -> int:
+    # difference hash: whether each pixel of a 9x8 grayscale thumbnail is brighter than its right neighbour
+    from PIL import Image
+    pixels = list(image.convert("L").resize(
+        (9, 8), Image.LANCZOS).getdata())
+    phash = 0
+    for row in range(8):
+        for column in range(8):
+            left = pixels[row * 9 + column]
+            right = pixels[row * 9 + column + 1]
+            phash = (phash << 1) | (1 if left > right else 0)
+    return phash
+
+
+def phash_bands(phash):
+    return [(phash >> (8 * band)) & 0xFF for band in range(PHASH_BANDS)]
+
+
+def image_info(path):
+    try:
+        from PIL import Image
+        with Image.open(path) as image:
+            return (image.size[0], image.size[1], perceptual_hash(image))
+    except Exception:
+        return (None, None, None)
+
+
+class AssetIndex:
+    # persistent record of an animal's images, kept in <directory>/index.db
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        is_new = not os.path.exists(directory + INDEX_FILENAME)
+        self.connection = sqlite3.connect(
+            directory + INDEX_FILENAME, timeout=30, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS images (
+            filename TEXT PRIMARY KEY,
+            number INTEGER NOT NULL,
+            hash TEXT,
+            width INTEGER,
+            height INTEGER,
+            aspect_ratio REAL,
+            url TEXT,
+            active INTEGER NOT NULL DEFAULT 0)''')
+        # indexes created before perceptual hashing need the extra columns
+        columns = [row[1] for row in self.connection.execute(
+            "PRAGMA table_info(images)").fetchall()]
+        for column in ["phash"] + band_columns():
+            if column not in columns:
+                self.connection.execute(
+                    "ALTER TABLE images ADD COLUMN " + column + " INTEGER")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS images_active ON images (active, number)")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS images_hash ON images (hash)")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS images_url ON images (url)")
+        for column in band_columns():
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS images_" + column + " ON images (" + column + ")")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        if is_new:
+            self.import_directory()
+
+    # record the files of a directory that predates the index. this is the only directory scan
+    def import_directory(self):
+        active_directory = self.directory + ACTIVE_PATH
+        active = set()
+        if os.path.exists(active_directory):
+            active = set(os.listdir(active_directory))
+        filenames = [f for f in os.listdir(self.directory) if os.path.isfile(
+            self.directory + f) and f.endswith(".jpg")]
+        for filename in sorted(filenames, key=file_number):
+            with open(self.directory + filename, 'rb') as f:
+                data = f.read()
+            (width, height, phash) = image_info(self.directory + filename)
+            # downloads are hashed from their normalized rendition, so imported files are too when they have one
+            if os.path.exists(self.directory + NORMALIZED_PATH + filename):
+                phash = image_info(self.directory +
+                                   NORMALIZED_PATH + filename)[2]
+            self.add_image(data, width, height, None,
+                           filename=filename, phash=phash)
+            if filename in active:
+                self.set_active(filename)
+        self.set_search_offset(len(filenames) + 1)
+
+    def execute(self, query, parameters=()):
+        with self.lock:
+            return self.connection.execute(query, parameters).fetchall()
+
+    # record a new image and return the filename allocated to it
+    def add_image(self, data, width, height, url, filename=None, phash=None) -> str:
+        aspect_ratio = None
+        if width and height:
+            aspect_ratio = height / width
+        bands = [None] * PHASH_BANDS
+        stored_phash = None
+        if phash is not None:
+            bands = phash_bands(phash)
+            # sqlite integers are signed 64 bit
+            stored_phash = phash - (1 << 64) if phash >= (1 << 63) else phash
+        with self.lock:
+            # numbers are allocated inside a write transaction, so concurrent writers never share a filename
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                number = self.connection.execute(
+                    "SELECT COALESCE(MAX(number), -1) + 1 FROM images").fetchone()[0]
+                if filename is None:
+                    filename = str(number) + ".jpg"
+                else:
+                    number = file_number(filename)
+                self.connection.execute("INSERT OR REPLACE INTO images (filename, number, hash, width, height, aspect_ratio, url, phash, " + ", ".join(band_columns()) + ") VALUES (?, ?, ?, ?, ?, ?, ?, ?, " + ", ".join(["?"] * PHASH_BANDS) + ")",
+                                        [filename, number, content_hash(data), width, height, aspect_ratio, url, stored_phash] + bands)
+                self.connection.execute("COMMIT")
+            except:
+                self.connection.execute("ROLLBACK")
+                raise
+        return filename
+
+    def remove_image(self, filename):
+        self.execute("DELETE FROM images WHERE filename = ?", (filename,))
+
+    def set_active(self, filename, active=True):
+        self.execute("UPDATE images SET active = ? WHERE filename = ?",
+                     (1 if active else 0, filename))
+
+    def image_count(self) -> int:
+        return self.execute("SELECT COUNT(*) FROM images")[0][0]
+
+    def active_count(self) -> int:
+        return self.execute("SELECT COUNT(*) FROM images WHERE active = 1")[0][0]
+
+    def active_filenames(self):
+        return [row[0] for row in self.execute("SELECT filename FROM images WHERE active = 1 ORDER BY number")]
+
+    def has_url(self, url) -> bool:
+        return len(self.execute("SELECT 1 FROM images WHERE url = ?", (url,))) > 0
+
+    # the filename of an image that is identical or nearly identical to the given one, or None
+    def find_duplicate(self, data, phash=None):
+        rows = self.execute(
+            "SELECT filename FROM images WHERE hash = ?", (content_hash(data),))
+        if len(rows) > 0 or phash is None:
+            return rows[0][0] if len(rows) > 0 else None
+        conditions = " OR ".join(
+            [column + " = ?" for column in band_columns()])
+        for (filename, stored_phash) in self.execute("SELECT filename, phash FROM images WHERE " + conditions, phash_bands(phash)):
+            if stored_phash is not None and hamming_distance(phash, stored_phash) <= NEAR_DUPLICATE_DISTANCE:
+                return filename
+        return None
+
+    # where the next search for a query should start. query is None for the default query
+    def search_offset(self, query=None) -> int:
+        rows = self.execute(
+            "SELECT value FROM meta WHERE key = ?", (search_offset_name(query),))
+        if len(rows) == 0:
+            return 1
+        return int(rows[0][0])
+
+    def set_search_offset(self, offset, query=None):
+        self.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                     (search_offset_name(query), str(offset)))
+
+
+def search_offset_name(query=None) -> str:
+    if query is None:
+        return "search_offset"
+    return "search_offset:" + query
+
+
+def band_columns():
+    return ["band" + str(band) for band in range(PHASH_BANDS)]
+
+
+def hamming_distance(hash1, hash2) -> int:
+    return bin((hash1 ^ hash2) & ((1 << 64) - 1)).count("1")
+
+
+def file_number(filename) -> int:
+    try:
+        return int(os.path.splitext(filename)[0])
+    except ValueError:
+        return -1
+
+
+def get_index(directory) -> AssetIndex:
+    with INDEXES_LOCK:
+        if directory not in INDEXES:
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            INDEXES[directory] = AssetIndex(directory)
+        return INDEXES[directory]
+
+
+# paths of an animal's active images, in the order they were downloaded
+def get_active_paths(asset_path, animal_name):
+    directory = asset_path + animal_name + "/"
+    return [directory + ACTIVE_PATH + filename for filename in get_index(directory).active_filenames()]
@@ -0,0 +1,209 @@
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+import numpy as np
+
+# times the versus and facts templates end to end on synthetic assets, with no network access or credentials.
+# run from the project directory:
+#   python3 benchmarks/render.py                          writes benchmarks/baseline.json
+#   python3 benchmarks/render.py results.json --compare benchmarks/baseline.json
+# the comparison fails if a case got slower than BENCHMARK_TOLERANCE times its baseline
+
+PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_BASELINE_PATH = PROJECT_PATH + "/benchmarks/baseline.json"
+
+# video scales relative to the 720x1280 templates, and seconds of narration per scene.
+# narration has to be longer than the fixed length clips of every scene, e.g. the 3 second winner clip of the versus video
+SCALES = [float(scale) for scale in os.environ.get(
+    "BENCHMARK_SCALES", "0.5,1.0").split(",")]
+SCENE_SECONDS = [float(seconds) for seconds in os.environ.get(
+    "BENCHMARK_SCENE_SECONDS", "4,8").split(",")]
+TEMPLATES = os.environ.get(
+    "BENCHMARK_TEMPLATES", "ANIMAL_VERSUS_VIDEO,FACTS_VIDEO").split(",")
+BACKEND = os.environ.get("BENCHMARK_BACKEND", "moviepy")
+FPS = int(os.environ.get("BENCHMARK_FPS", 30))
+BENCHMARK_TOLERANCE = float(os.environ.get("BENCHMARK_TOLERANCE", 1.25))
+
+FIXTURE_ANIMALS = ["Benchmark Lion", "Benchmark Tiger"]
+# (width, height) of the synthetic images, cycled through for each animal. mostly portrait, as downloads are, with some odd ones
+IMAGE_SIZES = [(720, 1280), (1080, 1920), (900, 1400), (640, 1136),
+               (1280, 720), (1200, 1600), (800, 800), (1536, 2048)]
+AUDIO_FPS = 44100
+
+
+def write_tone(path, seconds, frequency, volume=0.3):
+    t = np.arange(int(seconds * AUDIO_FPS)) / AUDIO_FPS
+    samples = (np.sin(2 * np.pi * frequency * t)
+               * volume * 32767).astype("<i2")
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(AUDIO_FPS)
+        f.writeframes(samples.tobytes())
+
+
+def write_image(path, size, seed):
+    from PIL import Image
+    (width, height) = size
+    rng = np.random.default_rng(seed)
+    # smooth gradients with noise, so the jpegs decode like photos rather than flat colour
+    x = np.linspace(0, 1, width)[None, :, None]
+    y = np.linspace(0, 1, height)[:, None, None]
+    colour = rng.uniform(0, 255, (1, 1, 3))
+    pixels = colour * x + (255 - colour) * y + \
+        rng.normal(0, 12, (height, width, 3))
+    Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(
+        path, quality=90)
+
+
+def make_fixtures(directory):
+    os.symlink(PROJECT_PATH + "/Overlays", directory + "Overlays")
+    # animal.py reads the animal table from the working directory when it is imported
+    os.symlink(PROJECT_PATH + "/animals.csv", directory + "animals.csv")
+    for animal_number, animal_name in enumerate(FIXTURE_ANIMALS):
+        active_directory = directory + "Assets/" + animal_name + "/Active/"
+        os.makedirs(active_directory)
+        for i in range(8):
+            write_image(active_directory + str(i) + ".jpg",
+                        IMAGE_SIZES[(i + animal_number) % len(IMAGE_SIZES)], animal_number * 100 + i)
+    os.makedirs(directory + "Narration/")
+    for seconds in SCENE_SECONDS:
+        for i in range(8):
+            write_tone(directory + "Narration/" + str(seconds) +
+                       "_" + str(i) + ".wav", seconds, 220 + 40 * i)
+    os.makedirs(directory + "BackgroundMusic/")
+    write_tone(directory + "BackgroundMusic/music.wav", 30, 110, 0.2)
+
+
+def run_case(directory, template_name, scale, scene_seconds):
+    # runs in its own process from the fixture directory, so peak memory and caches belong to this case only
+    os.chdir(directory)
+    shutil.rmtree("Cache", ignore_errors=True)
+    sys.path.insert(0, PROJECT_PATH)
+    import video
+    from moviepy.editor import AudioFileClip
+
+    template = getattr(video, template_name).scaled(scale)
+    template = template.set_background_audio(AudioFileClip(
+        "BackgroundMusic/music.wav", fps=AUDIO_FPS))
+    audio_count = len(
+        [scene for scene in template.scenes if scene.has_audio])
+    audio_clips = [AudioFileClip("Narration/" + str(scene_seconds) + "_" + str(i) + ".wav", fps=AUDIO_FPS)
+                   for i in range(audio_count)]
+    paths = []
+    for i in range(8):
+        for animal_name in FIXTURE_ANIMALS:
+            paths.append("Assets/" + animal_name +
+                         "/Active/" + str(i) + ".jpg")
+    for scene_plan in template.plan(paths, audio_clips):
+        for clip_plan in scene_plan.clips:
+            if clip_plan.duration <= 0:
+                raise ValueError(str(scene_seconds) + " seconds of narration is too short for the fixed length clips of " +
+                                 template_name + ". Use longer BENCHMARK_SCENE_SECONDS.")
+
+    start = time.perf_counter()
+    clip = template.build(paths, audio_clips)
+    build_seconds = time.perf_counter() - start
+    duration = clip.duration
+
+    output_path = "Output/benchmark.mp4"
+    start = time.perf_counter()
+    template.render(paths, audio_clips, output_path, fps=FPS,
+                    backend=video.RenderBackend(BACKEND))
+    render_seconds = time.perf_counter() - start
+
+    frames = int(duration * FPS)
+    return {"template": template_name, "scale": scale, "width": template.width, "height": template.height,
+            "scene_seconds": scene_seconds, "video_seconds": round(duration, 3), "fps": FPS, "backend": BACKEND,
+            "build_seconds": round(build_seconds, 4), "render_seconds": round(render_seconds, 4),
+            "frames": frames, "frames_per_second": round(frames / render_seconds, 3),
+            "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            "peak_encoder_rss_bytes": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+            "output_bytes": os.path.getsize(output_path)}
+
+
+def case_name(case) -> str:
+    return case["template"] + "@" + str(case["scale"]) + "x/" + str(case["scene_seconds"]) + "s"
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=PROJECT_PATH, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks():
+    directory = tempfile.mkdtemp(prefix="videobuilder_benchmark") + "/"
+    try:
+        make_fixtures(directory)
+        cases = []
+        for template_name in TEMPLATES:
+            for scale in SCALES:
+                for scene_seconds in SCENE_SECONDS:
+                    result = subprocess.run([sys.executable, os.path.abspath(__file__), "--case", directory, template_name, str(scale), str(scene_seconds)],
+                                            capture_output=True, text=True)
+                    if result.returncode != 0:
+                        print(result.stderr)
+                        raise RuntimeError(template_name + " at " + str(scale) + "x with " + str(scene_seconds) +
+                                           "s scenes failed.")
+                    case = json.loads(result.stdout.strip().splitlines()[-1])
+                    print(case_name(case) + ": " + str(case["render_seconds"]) + "s, " +
+                          str(case["frames_per_second"]) + " fps")
+                    cases.append(case)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return {"commit": git_commit(), "python": platform.python_version(), "machine": platform.machine(),
+            "cpu_count": os.cpu_count(), "cases": cases}
+
+
+# print how each case compares to the baseline, and return the cases that got slower than the tolerance allows
+def compare(report, baseline):
+    baseline_cases = {case_name(case): case for case in baseline["cases"]}
+    regressions = []
+    for case in report["cases"]:
+        name = case_name(case)
+        if name not in baseline_cases:
+            print(name + ": not in baseline")
+            continue
+        ratio = case["render_seconds"] / \
+            max(baseline_cases[name]["render_seconds"], 1e-9)
+        print(name + ": " + str(round(ratio, 3)) + "x baseline render time, " +
+              str(case["peak_rss_bytes"] - baseline_cases[name]["peak_rss_bytes"]) + " bytes peak memory difference")
+        if ratio > BENCHMARK_TOLERANCE:
+            regressions.append(name)
+    return regressions
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--case":
+        print(json.dumps(run_case(sys.argv[2], sys.argv[3],
+              float(sys.argv[4]), float(sys.argv[5]))))
+        sys.exit(0)
+
+    args = list(sys.argv[1:])
+    compare_path = None
+    if "--compare" in args:
+        compare_path = args[args.index("--compare") + 1]
+        args.remove(compare_path)
+        args.remove("--compare")
+    output_path = args[0] if len(args) > 0 else DEFAULT_BASELINE_PATH
+
+    report = run_benchmarks()
+    with open(output_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("Results written to " + output_path)
+    if compare_path is not None:
+        with open(compare_path) as f:
+            regressions = compare(report, json.load(f))
+        if len(regressions) > 0:
+            print("Slower than " + str(BENCHMARK_TOLERANCE) +
+                  "x baseline: " + ", ".join(regressions))
+            sys.exit(1)
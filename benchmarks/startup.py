@@ -0,0 +1,50 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+# measures how long the CLI takes to start up and validate its arguments, and fails if it goes over budget.
+# run from the project directory: python3 benchmarks/startup.py
+
+STARTUP_BUDGET_SECONDS = float(os.environ.get("STARTUP_BUDGET_SECONDS", 1.0))
+RUNS = int(os.environ.get("STARTUP_RUNS", 5))
+
+# modules that must only be imported by the actions that use them
+LAZY_MODULES = ["moviepy", "openai", "elevenlabslib", "requests", "video", "images"]
+
+STARTUP_PROGRAM = '''
+import json
+import sys
+import main
+main.validate_args("-vs", "-video", ["Lion", "Tiger"])
+loaded = [name for name in {lazy_modules} if name in sys.modules]
+print(json.dumps(loaded))
+'''
+
+
+def measure_startup():
+    program = STARTUP_PROGRAM.format(lazy_modules=LAZY_MODULES)
+    timings = []
+    loaded = []
+    for i in range(RUNS):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, "-c", program],
+                                capture_output=True, text=True, check=True)
+        timings.append(time.perf_counter() - start)
+        loaded = json.loads(result.stdout.strip().splitlines()[-1])
+    timings.sort()
+    return {"runs": RUNS, "median_seconds": timings[len(timings) // 2], "min_seconds": timings[0], "max_seconds": timings[-1],
+            "budget_seconds": STARTUP_BUDGET_SECONDS, "eagerly_loaded_modules": loaded}
+
+
+if __name__ == "__main__":
+    report = measure_startup()
+    print(json.dumps(report, indent=2))
+    if report["median_seconds"] > STARTUP_BUDGET_SECONDS:
+        print("Startup is over budget.")
+        sys.exit(1)
+    if len(report["eagerly_loaded_modules"]) > 0:
+        print("Modules loaded at startup that should be lazy: " +
+              ", ".join(report["eagerly_loaded_modules"]))
+        sys.exit(1)
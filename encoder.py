@@ -0,0 +1,167 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import numpy as np
+from typing import List
+from filter_graph import FFMPEG_BINARY, FilterGraph
+from profiler import PROFILER
+
+# video and audio codecs used for each container
+CONTAINER_CODECS = {
+    "mp4": ("libx264", "aac"),
+    "mov": ("libx264", "aac"),
+    "mkv": ("libx264", "aac"),
+    "webm": ("libvpx-vp9", "libopus"),
+}
+
+
+class Rendition:
+    # one output of a render. bitrate (e.g. "8M") takes precedence over crf when given. an unnamed rendition is written to the output path as is
+    def __init__(self, name, height, width, crf=23, bitrate=None, container="mp4"):
+        if container not in CONTAINER_CODECS:
+            raise ValueError("Unsupported container " + container +
+                             ". Use one of " + ", ".join(CONTAINER_CODECS))
+        self.name = name
+        self.height = height
+        self.width = width
+        self.crf = crf
+        self.bitrate = bitrate
+        self.container = container
+
+    def path(self, output_path) -> str:
+        if self.name is None:
+            return output_path
+        return os.path.splitext(output_path)[0] + "_" + self.name + "." + self.container
+
+    def codec_args(self, fps, preset="medium", audio=True) -> List[str]:
+        (video_codec, audio_codec) = CONTAINER_CODECS[self.container]
+        args = ["-c:v", video_codec]
+        if video_codec == "libx264":
+            args += ["-preset", preset]
+        if self.bitrate is not None:
+            args += ["-b:v", str(self.bitrate)]
+        else:
+            args += ["-crf", str(self.crf)]
+            if video_codec == "libvpx-vp9":
+                # constant quality mode for vp9
+                args += ["-b:v", "0"]
+        args += ["-pix_fmt", "yuv420p", "-r", str(fps)]
+        if not audio:
+            return args + ["-an"]
+        return args + ["-c:a", audio_codec]
+
+
+# the renditions we publish: standard size shorts and a small preview. active images and overlays are 720x1280,
+# so a 1080p rendition would only be upscaled 720p content that costs 2.25 times as much to composite
+SHORTS_RENDITIONS = [
+    Rendition("720p", 1280, 720, crf=23),
+    Rendition("preview", 640, 360, crf=30),
+]
+
+
+# the largest rendition. the video is composited once at this size and scaled down for the others
+def master_rendition(renditions: List[Rendition]) -> Rendition:
+    return max(renditions, key=lambda rendition: rendition.height * rendition.width)
+
+
+# split the finished video and audio once per rendition and return the output arguments of every rendition. audio_label is None for silent video
+def rendition_outputs(graph: FilterGraph, video_label, audio_label, renditions: List[Rendition], output_path, fps=30, preset="medium") -> List[str]:
+    video_labels = [video_label]
+    audio_labels = [audio_label]
+    if len(renditions) > 1:
+        video_labels = graph.add_split(video_label, len(renditions))
+        if audio_label is not None:
+            audio_labels = graph.add_split(
+                audio_label, len(renditions), "asplit")
+    args = []
+    for index, rendition in enumerate(renditions):
+        scaled = graph.add_filter([video_labels[index]], "scale={w}:{h}:flags=lanczos,setsar=1,format=yuv420p".format(
+            w=rendition.width, h=rendition.height))
+        args += ["-map", "[" + scaled + "]"]
+        if audio_label is not None:
+            args += ["-map", "[" + audio_labels[index] + "]"]
+        args += rendition.codec_args(fps, preset, audio_label is not None) + \
+            ["-shortest", rendition.path(output_path)]
+    return args
+
+
+class FrameWriter:
+    # writes each run of identical frames once, as a ppm image listed in an ffconcat script with the run's duration.
+    # ffmpeg repeats the frames itself, so still parts of a video cost one frame instead of one per 1/fps
+    def __init__(self, directory, fps=30):
+        self.directory = directory
+        self.fps = fps
+        self.entries = []
+        self.frames_written = 0
+        self.frames_elided = 0
+        self.buffer = None
+
+    def write(self, frame, count=1):
+        frame = self.as_bytes(frame)
+        (height, width) = frame.shape[:2]
+        filename = str(len(self.entries)) + ".ppm"
+        with open(self.directory + filename, 'wb') as f:
+            f.write(("P6\n" + str(width) + " " + str(height) + "\n255\n").encode())
+            f.write(memoryview(frame).cast("B"))
+        self.entries.append((filename, count))
+        self.frames_written += 1
+        self.frames_elided += count - 1
+
+    def as_bytes(self, frame):
+        if frame.dtype == np.uint8 and frame.flags["C_CONTIGUOUS"] and frame.shape[2] == 3:
+            return frame
+        # converted frames go through one buffer that is reused for every frame
+        if self.buffer is None or self.buffer.shape != frame.shape[:2] + (3,):
+            self.buffer = np.empty(frame.shape[:2] + (3,), dtype=np.uint8)
+        np.copyto(self.buffer, frame[:, :, :3], casting="unsafe")
+        return self.buffer
+
+    def close(self) -> str:
+        script_path = self.directory + "frames.ffconcat"
+        with open(script_path, 'w') as f:
+            f.write("ffconcat version 1.0\n")
+            for (filename, count) in self.entries:
+                f.write("file " + filename + "\n")
+                f.write("duration " + repr(count / self.fps) + "\n")
+            # the duration of the last entry is only applied when the file is listed again
+            if len(self.entries) > 0:
+                f.write("file " + self.entries[-1][0] + "\n")
+        return script_path
+
+
+# encode a timeline to every rendition with a single ffmpeg process. each distinct frame is composited and written once
+def write_renditions(timeline, audio_path, renditions: List[Rendition], output_path, fps=30, preset="medium"):
+    directory = tempfile.mkdtemp(prefix="frames") + "/"
+    try:
+        writer = FrameWriter(directory, fps)
+        with PROFILER.stage("composite"):
+            for (frame, count) in timeline.frame_runs(fps):
+                writer.write(frame, count)
+            script_path = writer.close()
+        PROFILER.count("frames_composited", writer.frames_written)
+        PROFILER.count("frames_output", writer.frames_written + writer.frames_elided)
+        print("composited " + str(writer.frames_written) + " frames, " +
+              str(writer.frames_elided) + " repeated frames left to the encoder.")
+
+        graph = FilterGraph()
+        video_index = graph.add_input(
+            ["-f", "concat", "-i", script_path])
+        # exactly as many frames as were written, so back to back segments add up to whole frames
+        video_label = graph.add_filter([str(video_index) + ":v"],
+                                       "fps=" + str(fps) + ",trim=end_frame=" + str(writer.frames_written + writer.frames_elided))
+        audio_label = None
+        if audio_path is not None:
+            audio_index = graph.add_input(["-i", audio_path])
+            audio_label = graph.add_filter(
+                [str(audio_index) + ":a"], "anull")
+        outputs = rendition_outputs(
+            graph, video_label, audio_label, renditions, output_path, fps, preset)
+        command = [FFMPEG_BINARY, "-y", "-loglevel", "error"] + graph.input_args() + \
+            ["-filter_complex", graph.script()] + outputs
+        print("rendering " + ", ".join(rendition.path(output_path)
+              for rendition in renditions) + "...")
+        with PROFILER.stage("encode"):
+            subprocess.run(command, check=True)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,195 @@
+import math
+import os
+import subprocess
+import video
+import encoder
+from filter_graph import FFMPEG_BINARY, FilterGraph
+from profiler import PROFILER
+
+
+def overlay_path(overlay):
+    return getattr(overlay, "filename", None)
+
+
+# the ffmpeg backend handles templates built entirely from still images and file backed overlays
+def supports(video_template) -> bool:
+    overlays = list(video_template.overlays)
+    for scene in video_template.scenes:
+        overlays += scene.overlays
+        for clip_format in scene.clip_formats:
+            if clip_format.style != video.ClipStyle.IMAGE:
+                return False
+            overlays += clip_format.overlays
+    for overlay in overlays:
+        if overlay_path(overlay) is None:
+            return False
+    background_audio = video_template.background_audio
+    if background_audio is not None and getattr(background_audio, "filename", None) is None:
+        return False
+    return True
+
+
+# seconds of the last frame repeated after a clip's stills are stacked and overlaid, since stacking inputs that end drops
+# their last frame. the clip's length is only set by the trim after it
+STILL_PADDING = 1.0
+
+
+def add_still(graph: FilterGraph, path, duration, fps) -> int:
+    return graph.add_input(["-loop", "1", "-framerate", str(fps), "-t", str(duration), "-i", path])
+
+
+# overlays are made for the template's full size, and are scaled down with the video for previews
+def overlay_input(graph: FilterGraph, index, scale=1.0) -> str:
+    if scale == 1.0:
+        return str(index) + ":v"
+    return graph.add_filter([str(index) + ":v"], "scale=iw*{s}:ih*{s}".format(s=scale))
+
+
+# first_frame and end_frame are the clip's frames in the video, so clips add up to the frames the MoviePy timeline renders
+def compile_clip(graph: FilterGraph, clip_plan, scene_overlays, video_height, video_width, fps, scale=1.0, first_frame=0, end_frame=None) -> str:
+    clip_format = clip_plan.clip_format
+    duration = clip_plan.duration
+    if end_frame is None:
+        end_frame = video.frame_count(duration, fps)
+    still_duration = (end_frame - first_frame) / fps
+    (crop_width, crop_height) = clip_format.crop_size(
+        video_height, video_width)
+    crop_width = int(crop_width)
+    crop_height = int(crop_height)
+
+    # scale each asset to the video height and crop it around its center, as format_clip does
+    assets = []
+    for path in clip_plan.asset_paths:
+        index = add_still(graph, path, still_duration, fps)
+        assets.append(graph.add_filter([str(index) + ":v"], "scale=-1:{h},crop='min(iw,{w})':'min(ih,{h2})',pad={w}:{h2}:(ow-iw)/2:(oh-ih)/2,setsar=1,format=rgb24".format(
+            h=video_height, w=crop_width, h2=crop_height)))
+
+    if clip_format.size == video.ClipSize.FULLSCREEN or len(assets) == 1:
+        clip = assets[0]
+    elif clip_format.size == video.ClipSize.VERTICALSPLITSCREEN:
+        clip = graph.add_filter(
+            assets, "vstack=inputs=" + str(len(assets)))
+    else:
+        clip = graph.add_filter(
+            assets, "hstack=inputs=" + str(len(assets)))
+
+    # center clips smaller than the frame, as the compose concatenation does
+    clip = graph.add_filter([clip], "pad={w}:{h}:(ow-iw)/2:(oh-ih)/2".format(
+        w=video_width, h=video_height))
+
+    for overlay in clip_format.overlays:
+        index = add_still(graph, overlay_path(overlay), still_duration, fps)
+        clip = graph.add_filter(
+            [clip, overlay_input(graph, index, scale)], "overlay=0:0:format=auto")
+
+    # crossfades in the reference render are fades against the black background of the concatenation
+    fades = ["tpad=stop_mode=clone:stop_duration=" + str(STILL_PADDING), "fps=" + str(fps),
+             "trim=end_frame=" + str(end_frame - first_frame), "setpts=PTS-STARTPTS"]
+    for transition in clip_format.transitions:
+        if transition == video.ClipTransition.CROSSFADE_IN:
+            fades.append("fade=t=in:st=0:d=" +
+                         str(video.TRANSITION_DURATION))
+        elif transition == video.ClipTransition.CROSSFADE_OUT:
+            fades.append("fade=t=out:st=" + str(max(duration - video.TRANSITION_DURATION, 0)) +
+                         ":d=" + str(video.TRANSITION_DURATION))
+    clip = graph.add_filter([clip], ",".join(fades))
+
+    for overlay in scene_overlays:
+        index = add_still(graph, overlay_path(overlay), still_duration, fps)
+        clip = graph.add_filter(
+            [clip, overlay_input(graph, index, scale)], "overlay=0:0:format=auto")
+
+    return clip
+
+
+# index of the first frame at or after time t
+def first_frame(t, fps, total_frames) -> int:
+    return min(int(math.ceil(t * fps - 1e-6)), total_frames)
+
+
+def compile_video(graph: FilterGraph, video_template, scene_plans, fps=30) -> str:
+    clips = []
+    # a frame at time t belongs to the clip playing at t, as in the MoviePy timeline
+    total_frames = video.frame_count(
+        sum(clip_plan.duration for scene_plan in scene_plans for clip_plan in scene_plan.clips), fps)
+    start = 0.0
+    for scene_plan in scene_plans:
+        for clip_plan in scene_plan.clips:
+            end = start + clip_plan.duration
+            (clip_start, clip_end) = (first_frame(start, fps, total_frames),
+                                      first_frame(end, fps, total_frames))
+            start = end
+            # clips shorter than a frame never show
+            if clip_end <= clip_start:
+                continue
+            clips.append(compile_clip(graph, clip_plan, scene_plan.scene.overlays,
+                                      video_template.height, video_template.width, fps, video_template.scale,
+                                      clip_start, clip_end))
+
+    final_video = graph.add_filter(
+        clips, "concat=n=" + str(len(clips)) + ":v=1:a=0")
+
+    # apply permanent video overlays
+    for overlay in video_template.overlays:
+        index = graph.add_input(
+            ["-loop", "1", "-framerate", str(fps), "-i", overlay_path(overlay)])
+        final_video = graph.add_filter(
+            [final_video, overlay_input(graph, index, video_template.scale)], "overlay=0:0:format=auto:shortest=1")
+
+    return graph.add_filter([final_video], "format=yuv420p")
+
+
+def compile_audio(graph: FilterGraph, video_template, scene_plans, fps=None) -> str:
+    # the narration and background music are mixed into a single file once, and read as is
+    index = graph.add_input(
+        ["-i", video_template.build_soundtrack(scene_plans, fps)])
+    return graph.add_filter([str(index) + ":a"], "anull")
+
+
+# segments are a whole number of frames long, so the narration is placed at the frame each segment starts on
+def concat_segments(video_template, scene_plans, segment_paths, output_path, fps=30):
+    list_path = output_path + ".segments"
+    with open(list_path, 'w') as f:
+        for segment_path in segment_paths:
+            f.write("file '" + os.path.abspath(segment_path).replace("'", "'\\''") + "'\n")
+
+    graph = FilterGraph()
+    graph.add_input(["-f", "concat", "-safe", "0", "-i", list_path])
+    audio_label = compile_audio(graph, video_template, scene_plans, fps)
+    command = [FFMPEG_BINARY, "-y", "-loglevel", "error"] + graph.input_args() + ["-filter_complex", graph.script(), "-map", "0:v", "-map", "[" + audio_label + "]",
+                                                                                  "-c:v", "copy", "-c:a", "aac", output_path]
+    print("joining " + str(len(segment_paths)) +
+          " segments into " + output_path + "...")
+    try:
+        subprocess.run(command, check=True)
+    finally:
+        os.remove(list_path)
+
+
+# with renditions, the video template should be sized for the largest one. every rendition is scaled from it in the same graph
+def render_video(video_template, paths, audioclips, output_path, fps=30, preset="medium", renditions=None):
+    scene_plans = video_template.plan(paths, audioclips)
+    graph = FilterGraph()
+    video_label = compile_video(graph, video_template, scene_plans, fps)
+    audio_label = compile_audio(graph, video_template, scene_plans)
+
+    if renditions:
+        outputs = encoder.rendition_outputs(
+            graph, video_label, audio_label, renditions, output_path, fps, preset)
+    else:
+        outputs = ["-map", "[" + video_label + "]", "-map", "[" + audio_label + "]",
+                   "-c:v", "libx264", "-preset", preset, "-pix_fmt", "yuv420p", "-r", str(fps), "-c:a", "aac", "-shortest", output_path]
+
+    script_path = output_path + ".filtergraph"
+    with open(script_path, 'w') as f:
+        f.write(graph.script())
+    command = [FFMPEG_BINARY, "-y", "-loglevel", "error"] + graph.input_args() + \
+        ["-filter_complex_script", script_path] + outputs
+    print("rendering " + output_path + " with ffmpeg...")
+    PROFILER.count("frames_output", video.frame_count(
+        sum(scene_plan.duration for scene_plan in scene_plans), fps))
+    try:
+        with PROFILER.stage("encode"):
+            subprocess.run(command, check=True)
+    finally:
+        os.remove(script_path)
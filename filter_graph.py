@@ -0,0 +1,39 @@
+import os
+from typing import List
+
+FFMPEG_BINARY = os.environ.get("FFMPEG_BINARY", "ffmpeg")
+
+
+class FilterGraph:
+    def __init__(self):
+        self.inputs = []
+        self.filters = []
+        self.label_count = 0
+
+    def add_input(self, args: List[str]) -> int:
+        self.inputs.append(args)
+        return len(self.inputs) - 1
+
+    def add_filter(self, inputs: List[str], filter: str) -> str:
+        label = "l" + str(self.label_count)
+        self.label_count += 1
+        self.filters.append(
+            "".join("[" + i + "]" for i in inputs) + filter + "[" + label + "]")
+        return label
+
+    # a filter with one output per copy of its input, e.g. split or asplit
+    def add_split(self, input: str, count: int, filter="split") -> List[str]:
+        labels = ["l" + str(self.label_count + i) for i in range(count)]
+        self.label_count += count
+        self.filters.append("[" + input + "]" + filter + "=" + str(count) +
+                            "".join("[" + label + "]" for label in labels))
+        return labels
+
+    def input_args(self) -> List[str]:
+        args = []
+        for input in self.inputs:
+            args += input
+        return args
+
+    def script(self) -> str:
+        return ";\n".join(self.filters)
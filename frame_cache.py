@@ -0,0 +1,90 @@
+import hashlib
+import os
+import numpy as np
+from collections import OrderedDict
+
+FRAME_CACHE_PATH = "Cache/Frames/"
+
+# memory budget for decoded frames held in process, in bytes
+FRAME_CACHE_MEMORY_LIMIT = int(os.environ.get(
+    "FRAME_CACHE_MEMORY_LIMIT", 512 * 1024 * 1024))
+
+if not os.path.exists(FRAME_CACHE_PATH):
+    os.makedirs(FRAME_CACHE_PATH)
+
+# (path, mtime, size) -> content hash, so unchanged files are only hashed once per process
+_file_hashes = {}
+
+
+def file_hash(path) -> str:
+    stat = os.stat(path)
+    stamp = (path, stat.st_mtime_ns, stat.st_size)
+    if stamp not in _file_hashes:
+        sha = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(chunk)
+        _file_hashes[stamp] = sha.hexdigest()
+    return _file_hashes[stamp]
+
+
+def frame_key(path, target_size, crop_box, clip_size) -> str:
+    key = "|".join([file_hash(path), str(target_size),
+                   str(crop_box), str(clip_size)])
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+class FrameCache:
+    def __init__(self, path=FRAME_CACHE_PATH, memory_limit=FRAME_CACHE_MEMORY_LIMIT):
+        self.path = path
+        self.memory_limit = memory_limit
+        self.memory_used = 0
+        self.frames = OrderedDict()
+
+    def get(self, key):
+        # memory tier
+        if key in self.frames:
+            self.frames.move_to_end(key)
+            return self.frames[key]
+        # disk tier, memory mapped so the frame is only paged in when read
+        disk_path = self.path + key + ".npy"
+        if os.path.exists(disk_path):
+            try:
+                frame = np.load(disk_path, mmap_mode='r')
+            except (ValueError, OSError):
+                os.remove(disk_path)
+                return None
+            self._remember(key, frame)
+            return frame
+        return None
+
+    def put(self, key, frame):
+        frame = np.ascontiguousarray(frame, dtype=np.uint8)
+        disk_path = self.path + key + ".npy"
+        if not os.path.exists(disk_path):
+            # write to a temporary file first so a crash never leaves a partial frame
+            temp_path = disk_path + "." + str(os.getpid()) + ".tmp"
+            with open(temp_path, 'wb') as f:
+                np.save(f, frame)
+            os.replace(temp_path, disk_path)
+        self._remember(key, frame)
+        return frame
+
+    def clear(self):
+        self.frames.clear()
+        self.memory_used = 0
+
+    def _remember(self, key, frame):
+        if key in self.frames:
+            return
+        if frame.nbytes > self.memory_limit:
+            return
+        self.frames[key] = frame
+        self.memory_used += frame.nbytes
+        # evict least recently used frames until under budget
+        while self.memory_used > self.memory_limit:
+            (_, evicted) = self.frames.popitem(last=False)
+            self.memory_used -= evicted.nbytes
+
+
+FRAME_CACHE = FrameCache()
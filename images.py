@@ -1,7 +1,15 @@
 import requests
+import requests.adapters
 import shutil
 import os
+import threading
+from io import BytesIO
+from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
 from animal import Animal
+from asset_index import get_index, perceptual_hash
+from profiler import PROFILER
+from scheduler import SCHEDULER
 from typing import List
 from dotenv import load_dotenv
 
@@ -15,49 +23,182 @@ ASPECT_RATIO = "t"
 GOOGLE_IMG_SEARCH_API_URL = 'https://customsearch.googleapis.com/customsearch/v1?cx={cx}&fileType=jpg&filter=1&imgSize=LARGE&imgType=photo&q={query}&searchType=image&start={start}&siteSearch=nationalgeographic.com&siteSearchFilter=i&key={api_key}'
 ASSETS_PATH = 'Assets/'
 ACTIVE_PATH = 'Active/'
+NORMALIZED_PATH = 'Normalized/'
+# renditions are stored at the default video width and height, so rendering never resizes raw downloads
+NORMALIZED_WIDTH = 720
+NORMALIZED_HEIGHT = 1280
+# images shorter than this would have to be upscaled too far to look good
+MIN_IMAGE_HEIGHT = 640
 ACTIVE_ASSETS_LIMIT = 8
 DOWNLOAD_QUOTA = 8
+# the custom search api returns results in pages of 10, and no results past the 100th
+SEARCH_PAGE_SIZE = 10
+SEARCH_RESULT_LIMIT = 100
+# queries tried in order, each one until its 100 results run out
+SEARCH_QUERIES = ["{name}", "{name} animal", "{name} wildlife"]
+
+# number of images downloaded at the same time, and (connect, read) timeouts in seconds
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", 8))
+REQUEST_TIMEOUT = (5, 30)
+
+SESSION = None
+SESSION_LOCK = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    # one pooled session shared by every search and download
+    global SESSION
+    with SESSION_LOCK:
+        if SESSION is None:
+            SESSION = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=IMAGE_WORKERS, pool_maxsize=IMAGE_WORKERS)
+            SESSION.mount("https://", adapter)
+            SESSION.mount("http://", adapter)
+        return SESSION
 
 
 def download_images(animals: List[Animal]):
     print("downloading images...")
-    for animal in animals:
-        path = ASSETS_PATH + animal.name + "/"
-        query_keyword = animal.name.replace(" ", "%20")
-        if not os.path.exists(path):
-            os.makedirs(path)
-        query_start = len([f for f in os.listdir(
-            path) if os.path.isfile(path + f)]) + 1
-        if query_start > 100:
-            print("Not enough images found")
-            return
-        num_downloaded = 0
-        while (num_downloaded < DOWNLOAD_QUOTA):
-            print(query_start)
-            res = requests.get(url=GOOGLE_IMG_SEARCH_API_URL.format(cx=GOOGLE_CUSTOM_SEARCH_CX,
-                                                                    query=query_keyword, api_key=GOOGLE_CUSTOM_SEARCH_API_KEY, start=str(query_start), aspect_ratio=ASPECT_RATIO))
-            res = res.json()
-            for index, item in enumerate(res['items']):
-                aspect_ratio = item["image"]["height"] / item["image"]["width"]
-                print(aspect_ratio)
-                if aspect_ratio >= (4/3):
-                    res2 = requests.get(item["link"], stream=True)
-                    if res2.status_code == 200:
-                        file_count = len([f for f in os.listdir(
-                            path) if os.path.isfile(path + f)])
-                        filename = str(file_count) + ".jpg"
-                        full_path = path + filename
-                        if not os.path.exists(full_path):
-                            with open(full_path, 'wb') as f:
-                                shutil.copyfileobj(res2.raw, f)
-                            print(filename + " Successfully Downloaded in " + path)
-                            num_downloaded += 1
-                        else:
-                            print("Image already downloaded.")
-                        activate_image(path, filename)
-                    else:
+    # search and download for every animal at the same time
+    with ThreadPoolExecutor(max_workers=max(len(animals), 1)) as executor:
+        for future in [executor.submit(download_animal_images, animal) for animal in animals]:
+            future.result()
+
+
+def search_images(query_keyword, query_start):
+    def search():
+        with PROFILER.request("image_search") as record:
+            res = get_session().get(url=GOOGLE_IMG_SEARCH_API_URL.format(cx=GOOGLE_CUSTOM_SEARCH_CX,
+                                                                         query=query_keyword, api_key=GOOGLE_CUSTOM_SEARCH_API_KEY, start=str(query_start), aspect_ratio=ASPECT_RATIO), timeout=REQUEST_TIMEOUT)
+            record["bytes"] = len(res.content)
+            # errors are raised rather than read as an empty page, which would skip the results for good.
+            # the scheduler backs off and retries rate limits
+            res.raise_for_status()
+        return res
+    return SCHEDULER.call("google_search", search).json().get('items', [])
+
+
+def fetch_image(url):
+    def fetch():
+        with PROFILER.request("image_download") as record:
+            res = get_session().get(url, timeout=REQUEST_TIMEOUT)
+            record["bytes"] = len(res.content)
+            if res.status_code == 429:
+                res.raise_for_status()
+        return res
+    try:
+        res = SCHEDULER.call("image_download", fetch)
+    except requests.RequestException:
+        return None
+    if res.status_code != 200:
+        return None
+    return res.content
+
+
+def download_animal_images(animal: Animal):
+    path = ASSETS_PATH + animal.name + "/"
+    queries = [query.format(name=animal.name) for query in SEARCH_QUERIES]
+    index = get_index(path)
+    # resume searching where the last search stopped, even if files were deleted since
+    query_number = 0
+    query_start = index.search_offset(search_offset_key(queries, 0))
+    num_downloaded = 0
+    while (num_downloaded < DOWNLOAD_QUOTA):
+        # the api never returns more than 100 results for a query, so move on to the next query
+        if query_start > SEARCH_RESULT_LIMIT:
+            print("Search results for \"" + queries[query_number] + "\" are used up.")
+            query_number += 1
+            if query_number == len(queries):
+                print("Not enough images found for " + animal.name + ". The results of all " +
+                      str(len(queries)) + " searches have been used.")
+                return
+            query_start = index.search_offset(
+                search_offset_key(queries, query_number))
+            continue
+        print(query_start)
+        items = search_images(
+            queries[query_number].replace(" ", "%20"), query_start)
+        query_start += SEARCH_PAGE_SIZE
+        index.set_search_offset(
+            query_start, search_offset_key(queries, query_number))
+        if len(items) == 0:
+            # no more results for this query
+            query_start = SEARCH_RESULT_LIMIT + 1
+            continue
+        candidates = []
+        for item in items:
+            aspect_ratio = item["image"]["height"] / item["image"]["width"]
+            print(aspect_ratio)
+            if aspect_ratio >= (4/3):
+                if index.has_url(item["link"]):
+                    print("Image already downloaded.")
+                else:
+                    candidates.append(item["link"])
+        # only download as many candidates at a time as are still needed to meet the quota
+        with ThreadPoolExecutor(max_workers=IMAGE_WORKERS) as executor:
+            while len(candidates) > 0 and num_downloaded < DOWNLOAD_QUOTA:
+                batch = candidates[:DOWNLOAD_QUOTA - num_downloaded]
+                candidates = candidates[len(batch):]
+                for url, image in zip(batch, executor.map(fetch_image, batch)):
+                    if image is None:
                         print("Image could not be retrieved.")
-            query_start += 10
+                        continue
+                    rendition = normalize_image(image)
+                    if rendition is None:
+                        continue
+                    # reject exact and near duplicates before they are written or activated
+                    phash = perceptual_hash(rendition)
+                    duplicate = index.find_duplicate(image, phash)
+                    if duplicate is not None:
+                        print("Image is a duplicate of " + duplicate + ".")
+                        continue
+                    (width, height) = Image.open(BytesIO(image)).size
+                    filename = index.add_image(
+                        image, width, height, url, phash=phash)
+                    with open(path + filename, 'wb') as f:
+                        f.write(image)
+                    save_rendition(rendition, path, filename)
+                    print(filename + " Successfully Downloaded in " + path)
+                    num_downloaded += 1
+                    activate_image(path, filename)
+
+
+# the first query keeps the offset key indexes had before there were several queries
+def search_offset_key(queries, query_number):
+    if query_number == 0:
+        return None
+    return queries[query_number]
+
+
+# decode a download once, and return its rendition at the normalized size, or None if the image is unusable
+def normalize_image(image_bytes):
+    try:
+        image = Image.open(BytesIO(image_bytes))
+        image.load()
+    except Exception:
+        print("Image could not be decoded.")
+        return None
+    (width, height) = image.size
+    if height < MIN_IMAGE_HEIGHT:
+        print("Image is too small.")
+        return None
+    # scale to the video height and crop around the center, as the video builder does
+    scaled_width = round(width * NORMALIZED_HEIGHT / height)
+    if scaled_width < NORMALIZED_WIDTH:
+        print("Image is too narrow.")
+        return None
+    image = image.convert("RGB").resize(
+        (scaled_width, NORMALIZED_HEIGHT), Image.LANCZOS)
+    left = (scaled_width - NORMALIZED_WIDTH) // 2
+    return image.crop((left, 0, left + NORMALIZED_WIDTH, NORMALIZED_HEIGHT))
+
+
+def save_rendition(rendition, directory, filename):
+    normalized_directory = directory + NORMALIZED_PATH
+    if not os.path.exists(normalized_directory):
+        os.makedirs(normalized_directory)
+    rendition.save(normalized_directory + filename, quality=95)
 
 
 def activate_image(directory, filename):
@@ -65,12 +206,16 @@ def activate_image(directory, filename):
     active_path = active_directory + filename
     if not os.path.exists(active_directory):
         os.makedirs(directory + ACTIVE_PATH)
-    num_active_images = len(os.listdir(active_directory))
-    if num_active_images <= ACTIVE_ASSETS_LIMIT:
+    index = get_index(directory)
+    if index.active_count() <= ACTIVE_ASSETS_LIMIT:
         if not os.path.exists(active_path):
-            shutil.copy(directory + filename, active_path)
+            # activate the normalized rendition if there is one, so rendering reads ready sized frames
+            source_path = directory + NORMALIZED_PATH + filename
+            if not os.path.exists(source_path):
+                source_path = directory + filename
+            shutil.copy(source_path, active_path)
+        index.set_active(filename)
 
 
 def get_image_count(animal):
-    path = animal.name
-    return len([name for name in os.listdir(path) if os.path.isfile(name)])
+    return get_index(ASSETS_PATH + animal.name + "/").image_count()
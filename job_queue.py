@@ -0,0 +1,246 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+from typing import List
+
+QUEUE_PATH = os.environ.get("QUEUE_PATH", "Cache/queue.db")
+
+# the stages of a video job and the stages each one waits for
+STAGES = ["images", "script", "audio", "video"]
+STAGE_DEPENDENCIES = {"images": [], "script": [],
+                      "audio": ["script"], "video": ["images", "audio"]}
+# workers claim either the network bound stages or the cpu bound render stage
+WORKER_STAGES = {"network": ["images", "script", "audio"],
+                 "render": ["video"], "all": STAGES}
+
+# a claimed stage is handed to another worker if its lease isn't renewed for this long
+LEASE_SECONDS = float(os.environ.get("QUEUE_LEASE_SECONDS", 60))
+MAX_ATTEMPTS = int(os.environ.get("QUEUE_MAX_ATTEMPTS", 3))
+# failed stages wait RETRY_DELAY * 2^(attempts - 1) seconds before they can be claimed again
+RETRY_DELAY = float(os.environ.get("QUEUE_RETRY_DELAY", 30))
+POLL_INTERVAL = float(os.environ.get("QUEUE_POLL_INTERVAL", 2))
+
+
+def worker_name() -> str:
+    return socket.gethostname() + ":" + str(os.getpid())
+
+
+# count a failed attempt of a stage, and either schedule its retry or give up. returns the stage's new status
+def record_failure(connection, job_id, stage, attempts, error, max_attempts=MAX_ATTEMPTS, retry_delay=RETRY_DELAY) -> str:
+    attempts += 1
+    status = 'pending'
+    available_at = time.time() + retry_delay * (2 ** (attempts - 1))
+    if attempts >= max_attempts:
+        status = 'failed'
+    connection.execute("UPDATE tasks SET status = ?, attempts = ?, available_at = ?, lease_owner = NULL, lease_expires = NULL, error = ?, updated = ? WHERE job_id = ? AND stage = ?",
+                       (status, attempts, available_at, error, time.time(), job_id, stage))
+    return status
+
+
+class JobQueue:
+    # durable queue of video jobs, one task per stage of each job, kept in a sqlite database.
+    # every claim happens in a write transaction, so any number of processes can share the database
+    def __init__(self, path=QUEUE_PATH):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory != "" and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(
+            path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            job TEXT NOT NULL,
+            options TEXT NOT NULL,
+            created REAL NOT NULL)''')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS tasks (
+            job_id INTEGER NOT NULL,
+            stage TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            available_at REAL NOT NULL DEFAULT 0,
+            lease_owner TEXT,
+            lease_expires REAL,
+            error TEXT,
+            updated REAL,
+            PRIMARY KEY (job_id, stage))''')
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, stage, available_at)")
+
+    def transaction(self, work):
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                result = work(self.connection)
+                self.connection.execute("COMMIT")
+                return result
+            except:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def execute(self, query, parameters=()):
+        with self.lock:
+            return self.connection.execute(query, parameters).fetchall()
+
+    # job: {"type": "-vs", "animals": [...], "winner": ...}, as in a batch manifest. returns the job's id
+    def enqueue(self, job: dict, options: List[str] = []) -> int:
+        def work(connection):
+            job_id = connection.execute("INSERT INTO jobs (job, options, created) VALUES (?, ?, ?)",
+                                        (json.dumps(job), json.dumps(options), time.time())).lastrowid
+            for stage in STAGES:
+                connection.execute(
+                    "INSERT INTO tasks (job_id, stage, updated) VALUES (?, ?, ?)", (job_id, stage, time.time()))
+            return job_id
+        return self.transaction(work)
+
+    # lease the next stage that is ready to run, or return None. an expired lease counts as a failed attempt, so a stage
+    # that keeps killing its worker is retried with backoff and gives up like any other failing stage.
+    # jobs closest to completion go first. admit(job, stage) can hold back stages, e.g. when a provider's quota is low
+    def claim(self, stages: List[str], owner=None, lease_seconds=LEASE_SECONDS, admit=None, max_attempts=MAX_ATTEMPTS, retry_delay=RETRY_DELAY):
+        if owner is None:
+            owner = worker_name()
+
+        def work(connection):
+            now = time.time()
+            for (job_id, stage, attempts) in connection.execute("SELECT job_id, stage, attempts FROM tasks WHERE status = 'running' AND lease_expires < ?",
+                                                                (now,)).fetchall():
+                status = record_failure(connection, job_id, stage, attempts, "lease expired",
+                                        max_attempts, retry_delay)
+                print("Lease on job " + str(job_id) + " " + stage + " expired" +
+                      (", giving up." if status == 'failed' else ", will retry."))
+            rows = connection.execute('''SELECT t.job_id, t.stage,
+                (SELECT COUNT(*) FROM tasks d WHERE d.job_id = t.job_id AND d.status = 'done') AS progress FROM tasks t
+                WHERE t.stage IN (''' + ", ".join("?" * len(stages)) + ''')
+                AND t.status = 'pending' AND t.available_at <= ?
+                ORDER BY progress DESC, t.job_id, t.available_at''', list(stages) + [now]).fetchall()
+            for (job_id, stage, progress) in rows:
+                dependencies = STAGE_DEPENDENCIES[stage]
+                if len(dependencies) > 0:
+                    done = connection.execute("SELECT COUNT(*) FROM tasks WHERE job_id = ? AND status = 'done' AND stage IN (" +
+                                              ", ".join("?" * len(dependencies)) + ")", [job_id] + dependencies).fetchone()[0]
+                    if done < len(dependencies):
+                        continue
+                (job, options) = connection.execute(
+                    "SELECT job, options FROM jobs WHERE id = ?", (job_id,)).fetchone()
+                (job, options) = (json.loads(job), json.loads(options))
+                if admit is not None and not admit(job, stage, options):
+                    continue
+                connection.execute("UPDATE tasks SET status = 'running', lease_owner = ?, lease_expires = ?, updated = ? WHERE job_id = ? AND stage = ?",
+                                   (owner, now + lease_seconds, now, job_id, stage))
+                return Task(self, job_id, stage, job, options, owner, progress)
+            return None
+        return self.transaction(work)
+
+    # extend a lease. returns False if the lease was lost to another worker
+    def heartbeat(self, job_id, stage, owner, lease_seconds=LEASE_SECONDS) -> bool:
+        def work(connection):
+            return connection.execute("UPDATE tasks SET lease_expires = ?, updated = ? WHERE job_id = ? AND stage = ? AND status = 'running' AND lease_owner = ?",
+                                      (time.time() + lease_seconds, time.time(), job_id, stage, owner)).rowcount > 0
+        return self.transaction(work)
+
+    def complete(self, job_id, stage, owner) -> bool:
+        def work(connection):
+            return connection.execute("UPDATE tasks SET status = 'done', lease_owner = NULL, lease_expires = NULL, error = NULL, updated = ? WHERE job_id = ? AND stage = ? AND lease_owner = ?",
+                                      (time.time(), job_id, stage, owner)).rowcount > 0
+        return self.transaction(work)
+
+    # record a failed attempt. the stage is retried with exponential backoff until it runs out of attempts
+    def fail(self, job_id, stage, owner, error, max_attempts=MAX_ATTEMPTS, retry_delay=RETRY_DELAY):
+        def work(connection):
+            row = connection.execute("SELECT attempts FROM tasks WHERE job_id = ? AND stage = ? AND lease_owner = ?",
+                                     (job_id, stage, owner)).fetchone()
+            if row is None:
+                return None
+            return record_failure(connection, job_id, stage, row[0], error, max_attempts, retry_delay)
+        return self.transaction(work)
+
+    # stage status of every job, e.g. {1: {"job": {...}, "stages": {"images": "done", "script": "running", ...}}}
+    def progress(self):
+        jobs = {}
+        for (job_id, job) in self.execute("SELECT id, job FROM jobs ORDER BY id"):
+            jobs[job_id] = {"job": json.loads(job), "stages": {}}
+        for (job_id, stage, status, attempts, error) in self.execute("SELECT job_id, stage, status, attempts, error FROM tasks"):
+            jobs[job_id]["stages"][stage] = {
+                "status": status, "attempts": attempts, "error": error}
+        return jobs
+
+    # whether any of these stages could still be claimed now or later. stages waiting on a failed stage never can
+    def has_work(self, stages: List[str]) -> bool:
+        for job in self.progress().values():
+            for stage in stages:
+                if job["stages"][stage]["status"] in ['pending', 'running'] and not self.is_blocked(job, stage):
+                    return True
+        return False
+
+    def is_blocked(self, job, stage) -> bool:
+        for dependency in STAGE_DEPENDENCIES[stage]:
+            if job["stages"][dependency]["status"] == 'failed' or self.is_blocked(job, dependency):
+                return True
+        return False
+
+
+class Task:
+    # a claimed stage of a job. the lease is renewed in the background while the stage runs
+    def __init__(self, queue: JobQueue, job_id, stage, job, options, owner, progress=0):
+        self.queue = queue
+        self.job_id = job_id
+        self.stage = stage
+        self.job = job
+        self.options = options
+        self.owner = owner
+        # number of the job's stages already done
+        self.progress = progress
+        self.stopped = threading.Event()
+
+    def keep_alive(self, lease_seconds=LEASE_SECONDS):
+        while not self.stopped.wait(lease_seconds / 3):
+            if not self.queue.heartbeat(self.job_id, self.stage, self.owner, lease_seconds):
+                print("Lost the lease on job " + str(self.job_id) +
+                      " " + self.stage + ".")
+                return
+
+    def run(self, execute, lease_seconds=LEASE_SECONDS) -> bool:
+        heartbeat = threading.Thread(
+            target=self.keep_alive, args=(lease_seconds,), daemon=True)
+        heartbeat.start()
+        try:
+            execute(self.job, self.stage, self.options, self.progress)
+        except Exception as e:
+            traceback.print_exc()
+            self.stopped.set()
+            status = self.queue.fail(
+                self.job_id, self.stage, self.owner, repr(e))
+            print("Job " + str(self.job_id) + " " + self.stage + " failed" +
+                  (", giving up." if status == 'failed' else ", will retry."))
+            return False
+        self.stopped.set()
+        self.queue.complete(self.job_id, self.stage, self.owner)
+        return True
+
+
+# claim and run stages until there is no work left for them (or forever, if exit_when_idle is False).
+# execute(job, stage, options, progress) runs one stage of a job and raises if it fails
+def run_worker(execute, kind="all", path=QUEUE_PATH, exit_when_idle=True, poll_interval=POLL_INTERVAL, admit=None):
+    queue = JobQueue(path)
+    stages = WORKER_STAGES[kind]
+    owner = worker_name()
+    print("Worker " + owner + " running " + ", ".join(stages) + " stages.")
+    completed = 0
+    while True:
+        task = queue.claim(stages, owner, admit=admit)
+        if task is None:
+            if exit_when_idle and not queue.has_work(stages):
+                break
+            time.sleep(poll_interval)
+            continue
+        print("Worker " + owner + " running job " +
+              str(task.job_id) + " " + task.stage + ".")
+        if task.run(execute):
+            completed += 1
+    print("Worker " + owner + " finished " + str(completed) + " stages.")
+    return completed
@@ -1,20 +1,41 @@
 import animal
 import script
 import sys
-import video
-import images
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from profiler import PROFILER
+from scheduler import SCHEDULER
 from typing import List
 
-args = sys.argv
-
-# args[1]: Video Type
-# args[2]: Action
-# args[3]: Primary Animal (Or Winner)
-# args[4+]: Secondary Animals
-
-print(args)
 VALID_VIDEO_TYPES = ['-vs', '-facts']
 VALID_ACTIONS = ['-images', '-script', '-audio', '-video', '-auto']
+# options can be given anywhere in the arguments
+# -ffmpeg: render the video with the native ffmpeg backend instead of MoviePy
+# -parallel: render each scene in its own process and join the segments
+# -nocache: request a new script even if the same prompt was answered before
+# -preview: render a quick low resolution, low frame rate draft with the same timing as the final video
+# -renditions: render every published size (720x1280 and a small preview) in a single pass
+# -profile (or --profile): write a json report of stage, scene and frame timings, memory, i/o and network requests to Profiles/
+VALID_OPTIONS = ['-ffmpeg', '-parallel', '-nocache',
+                 '-preview', '-renditions', '-profile', '--profile']
+BATCH_ACTION = '-batch'
+# queue the jobs of a manifest, run queue workers, or show the progress of queued jobs
+ENQUEUE_ACTION = '-enqueue'
+WORKER_ACTION = '-worker'
+QUEUE_ACTION = '-queue'
+
+# number of warm worker processes used for batch jobs
+BATCH_WORKERS = int(os.environ.get("BATCH_WORKERS", 1))
+
+# provider usage of a job when nothing is cached yet: searches per animal, and characters of narration per script
+ESTIMATED_SEARCHES_PER_ANIMAL = 2
+ESTIMATED_SCRIPT_CHARACTERS = {"VERSUS": 1600, "FIVE_FACTS": 900}
+# the provider each network stage of a queued job uses
+STAGE_PROVIDERS = {"images": "google_search",
+                   "script": "openai", "audio": "tts"}
 
 
 def validate_args(type: str, action: str, animals: List[str]) -> bool:
@@ -31,12 +52,13 @@ def validate_args(type: str, action: str, animals: List[str]) -> bool:
     return True
 
 
-def gen_script(script_type: script.ScriptType, animals: List[animal.Animal], primary_animal: animal.Animal):
+def gen_script(script_type: script.ScriptType, animals: List[animal.Animal], primary_animal: animal.Animal, options: List[str] = []):
     print("generating script...")
+    use_cache = '-nocache' not in options
     if script_type == script.ScriptType.VERSUS:
-        script.generate_vs_script(animals, primary_animal)
+        script.generate_vs_script(animals, primary_animal, use_cache)
     elif script_type == script.ScriptType.FIVE_FACTS:
-        script.generate_facts_script(animals)
+        script.generate_facts_script(animals, use_cache)
 
 
 def gen_audio(script_type: script.ScriptType, animals: List[animal.Animal]):
@@ -45,40 +67,355 @@ def gen_audio(script_type: script.ScriptType, animals: List[animal.Animal]):
     script.get_tts_audio(path)
 
 
-def gen_video(script_type: script.ScriptType, animals: List[animal.Animal], primary_animal: animal.Animal):
+def gen_images(animals: List[animal.Animal]):
+    import images
+    images.download_images(animals)
+
+
+def gen_video(script_type: script.ScriptType, animals: List[animal.Animal], primary_animal: animal.Animal, options: List[str] = []):
     print("generating video...")
+    # MoviePy and the overlays are only loaded when a video is actually rendered
+    import video
+    backend = video.RENDER_BACKEND
+    if '-ffmpeg' in options:
+        backend = video.RenderBackend.FFMPEG
+    elif '-parallel' in options:
+        backend = video.RenderBackend.PARALLEL
+    quality = video.FINAL_QUALITY
+    if '-preview' in options:
+        quality = video.PREVIEW_QUALITY
+    renditions = None
+    if '-renditions' in options:
+        import encoder
+        renditions = encoder.SHORTS_RENDITIONS
+    # returns the paths of the videos written
     if script_type == script.ScriptType.VERSUS:
-        video.gen_animal_vs_video(animals[0], animals[1], primary_animal)
+        return video.gen_animal_vs_video(
+            animals[0], animals[1], primary_animal, backend=backend, quality=quality, renditions=renditions)
     elif script_type == script.ScriptType.FIVE_FACTS:
-        video.gen_animal_facts_video(primary_animal)
+        return video.gen_animal_facts_video(
+            primary_animal, backend=backend, quality=quality, renditions=renditions)
 
 
-if validate_args(args[1], args[2], args[3:]):
+# the script type, animals and primary animal of validated args
+def parse_args(args: List[str]):
     script_type = None
     animals = []
-    primary_animal = animal.get_animal(args[3])
-    if args[1] == VALID_VIDEO_TYPES[0]:
+    primary_animal = animal.get_animal(args[2])
+    if args[0] == VALID_VIDEO_TYPES[0]:
         script_type = script.ScriptType.VERSUS
-        for arg in args[4:]:
+        for arg in args[3:]:
             animals.append(animal.get_animal(arg))
-    elif args[1] == VALID_VIDEO_TYPES[1]:
+    elif args[0] == VALID_VIDEO_TYPES[1]:
         script_type = script.ScriptType.FIVE_FACTS
         animals.append(primary_animal)
+    return (script_type, animals, primary_animal)
 
-    if args[2] == VALID_ACTIONS[0]:
-        images.download_images(animals)
-    elif args[2] == VALID_ACTIONS[1]:
-        gen_script(script_type, animals, primary_animal)
-    elif args[2] == VALID_ACTIONS[2]:
-        gen_audio(script_type, animals)
-    elif args[2] == VALID_ACTIONS[3]:
-        gen_video(script_type, animals, primary_animal)
-    elif args[2] == VALID_ACTIONS[4]:
-        # get images
-        images.download_images(animals)
-        # make script
-        gen_script(script_type, animals, primary_animal)
-        # make audio
+
+# args: [video type, action, primary animal (or winner), secondary animals...]
+def run(args: List[str], options: List[str] = []) -> bool:
+    if len(args) < 3 or not validate_args(args[0], args[1], args[2:]):
+        return False
+    (script_type, animals, primary_animal) = parse_args(args)
+
+    if args[1] == VALID_ACTIONS[0]:
+        with PROFILER.stage("images"):
+            gen_images(animals)
+    elif args[1] == VALID_ACTIONS[1]:
+        with PROFILER.stage("script"):
+            gen_script(script_type, animals, primary_animal, options)
+    elif args[1] == VALID_ACTIONS[2]:
+        with PROFILER.stage("audio"):
+            gen_audio(script_type, animals)
+    elif args[1] == VALID_ACTIONS[3]:
+        with PROFILER.stage("video"):
+            gen_video(script_type, animals, primary_animal, options)
+    elif args[1] == VALID_ACTIONS[4]:
+        if not run_auto(script_type, animals, primary_animal, options):
+            raise RuntimeError("Some stages failed. Run again to resume.")
+    return True
+
+
+ASSETS_PATH = "Assets/"
+# options that change the rendered video
+VIDEO_OPTIONS = ['-ffmpeg', '-parallel', '-preview', '-renditions']
+# code and overlays the rendered video depends on
+VIDEO_SOURCES = ["video.py", "ffmpeg_render.py", "encoder.py", "soundtrack.py"]
+OVERLAYS_PATH = "Overlays/"
+
+
+def video_sources() -> List[str]:
+    sources = list(VIDEO_SOURCES)
+    if os.path.exists(OVERLAYS_PATH):
+        sources += [OVERLAYS_PATH + f for f in sorted(os.listdir(OVERLAYS_PATH))]
+    return [source for source in sources if os.path.exists(source)]
+
+
+# -auto as a dependency graph: images and script at the same time, then audio, then video.
+# stages that are up to date since the last run are skipped, so a run after a failure resumes where it stopped
+def run_auto(script_type: script.ScriptType, animals: List[animal.Animal], primary_animal: animal.Animal, options: List[str] = []) -> bool:
+    import pipeline
+    import asset_index
+    from frame_cache import file_hash
+    directory = script.get_directory_name(script_type, animals)
+    animal_names = [a.name for a in animals]
+
+    def images_stage():
+        gen_images(animals)
+        paths = []
+        for animal_name in animal_names:
+            paths += asset_index.get_active_paths(ASSETS_PATH, animal_name)
+        return paths
+
+    def script_stage():
+        gen_script(script_type, animals, primary_animal, options)
+        return [script.get_script_path(directory)]
+
+    def audio_stage():
         gen_audio(script_type, animals)
-        # make video
-        gen_video(script_type, animals, primary_animal)
+        lines = script.read_script_from_file(script.get_script_path(directory))
+        if len(lines) == 0:
+            raise RuntimeError("No script to narrate in " + directory)
+        audio_path = script.get_script_audio_path(script_type, animals)
+        return [audio_path + str(i) + ".wav" for i in range(len(lines))]
+
+    def video_stage():
+        return gen_video(script_type, animals, primary_animal, options)
+
+    stages = [
+        pipeline.Stage("images", images_stage, lambda: animal_names),
+        pipeline.Stage("script", script_stage, lambda: [script_type.name, animal_names, primary_animal.name],
+                       always_run='-nocache' in options),
+        pipeline.Stage("audio", audio_stage, script.tts_settings,
+                       dependencies=["script"]),
+        pipeline.Stage("video", video_stage, lambda: [primary_animal.name, [option for option in options if option in VIDEO_OPTIONS],
+                                                     {source: file_hash(source) for source in video_sources()}],
+                       dependencies=["images", "audio"]),
+    ]
+    job_name = "|".join([script_type.name, primary_animal.name] + animal_names)
+    return pipeline.Pipeline(job_name, stages).run()
+
+
+# a manifest is a json list of jobs, e.g. {"type": "-vs", "action": "-auto", "animals": ["Wolf", "Mountain Lion"], "winner": "Mountain Lion"}
+def read_manifest(manifest_path) -> List[dict]:
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def job_args(job: dict) -> List[str]:
+    job_type = job.get("type", VALID_VIDEO_TYPES[0])
+    animals = job.get("animals", [])
+    winner = job.get("winner")
+    if winner is None and len(animals) > 0:
+        winner = animals[0]
+    args = [job_type, job.get("action", VALID_ACTIONS[4]), winner]
+    if job_type == VALID_VIDEO_TYPES[0]:
+        args += animals
+    return args
+
+
+def run_job(job: dict, options: List[str] = []) -> dict:
+    status = {"job": job, "status": "ok", "error": None}
+    start = time.time()
+    try:
+        if not run(job_args(job), options):
+            status["status"] = "invalid"
+    except Exception as e:
+        traceback.print_exc()
+        status["status"] = "failed"
+        status["error"] = repr(e)
+    status["seconds"] = round(time.time() - start, 3)
+    return status
+
+
+# generate the scripts of every job that needs one concurrently up front. the jobs themselves then reuse the cached responses
+def gen_batch_scripts(jobs: List[dict], options: List[str] = []):
+    script_jobs = []
+    for job in jobs:
+        args = job_args(job)
+        if args[1] not in [VALID_ACTIONS[1], VALID_ACTIONS[4]] or not validate_args(args[0], args[1], args[2:]):
+            continue
+        winner = animal.get_animal(args[2])
+        if args[0] == VALID_VIDEO_TYPES[0]:
+            script_jobs.append((script.ScriptType.VERSUS, [
+                               animal.get_animal(name) for name in args[3:]], winner))
+        else:
+            script_jobs.append((script.ScriptType.FIVE_FACTS, [winner], winner))
+    if len(script_jobs) > 0:
+        print("generating " + str(len(script_jobs)) + " scripts...")
+        try:
+            script.generate_scripts(
+                script_jobs, use_cache='-nocache' not in options)
+        except Exception:
+            # each job reports its own failure when it runs
+            traceback.print_exc()
+        # the responses are cached now, so the jobs must not bypass the cache again
+        options = [option for option in options if option != '-nocache']
+    return options
+
+
+def run_batch(manifest_path, options: List[str] = [], workers=BATCH_WORKERS) -> List[dict]:
+    jobs = read_manifest(manifest_path)
+    statuses = []
+    # jobs closest to completion first, and only as many as the provider quotas left today can finish
+    jobs = sorted(jobs, key=job_progress, reverse=True)
+    (jobs, deferred) = admit_jobs(jobs, options)
+    for job in deferred:
+        print("Not enough quota left for " + json.dumps(job) + ". Deferred.")
+        statuses.append({"job": job, "status": "deferred", "error": None})
+    options = gen_batch_scripts(jobs, options)
+    if workers <= 1:
+        # one warm process: modules, provider clients and templates are loaded once for every job
+        for job in jobs:
+            statuses.append(run_job(job, options))
+    else:
+        # a pool of warm processes, each one reused for many jobs
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            statuses += list(executor.map(
+                run_job, jobs, [options] * len(jobs)))
+    status_path = manifest_path + ".status.json"
+    with open(status_path, 'w') as f:
+        json.dump(statuses, f, indent=2)
+    succeeded = len([status for status in statuses if status["status"] == "ok"])
+    print(str(succeeded) + " of " + str(len(statuses)) +
+          " jobs succeeded. Status written to " + status_path)
+    return statuses
+
+
+# provider usage expected from the stages of a job that haven't run yet, e.g. {"google_search": 4, "openai": 1, "tts": 1600}
+def estimate_job_quota(job: dict, options: List[str] = []) -> dict:
+    args = job_args(job)
+    if not validate_args(args[0], args[1], args[2:]):
+        return {}
+    (script_type, animals, primary_animal) = parse_args(args)
+    lines = script.read_script_from_file(script.get_script_path(
+        script.get_directory_name(script_type, animals)))
+    estimates = {}
+    if args[1] in [VALID_ACTIONS[0], VALID_ACTIONS[4]]:
+        estimates["google_search"] = ESTIMATED_SEARCHES_PER_ANIMAL * \
+            len(animals)
+    if args[1] in [VALID_ACTIONS[1], VALID_ACTIONS[4]] and (len(lines) == 0 or '-nocache' in options):
+        estimates["openai"] = 1
+    if args[1] in [VALID_ACTIONS[2], VALID_ACTIONS[4]]:
+        if len(lines) > 0:
+            # only lines that aren't cached will be synthesized
+            estimates["tts"] = sum(len(line) for line in lines if not os.path.exists(
+                script.TTS_CACHE_PATH + script.tts_key(line) + ".wav"))
+        else:
+            estimates["tts"] = ESTIMATED_SCRIPT_CHARACTERS[script_type.name]
+    return estimates
+
+
+# number of a job's stages whose output already exists. jobs closest to completion are run first
+def job_progress(job: dict) -> int:
+    args = job_args(job)
+    if not validate_args(args[0], args[1], args[2:]):
+        return 0
+    (script_type, animals, primary_animal) = parse_args(args)
+    directory = script.get_directory_name(script_type, animals)
+    audio_path = script.get_script_audio_path(script_type, animals)
+    return len([path for path in [script.get_script_path(directory), audio_path + script.AUDIO_MANIFEST_FILENAME] if os.path.exists(path)])
+
+
+# split jobs into those whose estimated usage fits in the remaining quotas, taken in order, and those that have to wait
+def admit_jobs(jobs: List[dict], options: List[str] = []):
+    admitted = []
+    deferred = []
+    total = {}
+    for job in jobs:
+        estimates = estimate_job_quota(job, options)
+        combined = {name: total.get(name, 0) + amount for (name, amount) in estimates.items()}
+        if SCHEDULER.admit(combined):
+            admitted.append(job)
+            total.update(combined)
+        else:
+            deferred.append(job)
+    return (admitted, deferred)
+
+
+# whether a queued job's network stage fits in the quota left for its provider
+def admit_stage(job: dict, stage: str, options: List[str] = []) -> bool:
+    provider = STAGE_PROVIDERS.get(stage)
+    if provider is None:
+        return True
+    estimates = estimate_job_quota(job, options)
+    return SCHEDULER.admit({provider: estimates.get(provider, 0)}, verbose=False)
+
+
+# run one stage of a queued job. raises if the stage fails, so the queue can retry it
+def run_queued_stage(job: dict, stage: str, options: List[str] = [], progress=0):
+    args = job_args(job)
+    if not validate_args(args[0], args[1], args[2:]):
+        raise ValueError("Invalid job " + json.dumps(job))
+    (script_type, animals, primary_animal) = parse_args(args)
+    # provider calls of jobs further along go first
+    SCHEDULER.priority = progress
+    with PROFILER.stage(stage):
+        if stage == "images":
+            gen_images(animals)
+        elif stage == "script":
+            gen_script(script_type, animals, primary_animal, options)
+        elif stage == "audio":
+            gen_audio(script_type, animals)
+            if not os.path.exists(script.get_script_audio_path(script_type, animals) + script.AUDIO_MANIFEST_FILENAME):
+                raise RuntimeError("No audio was generated")
+        elif stage == "video":
+            gen_video(script_type, animals, primary_animal, options)
+
+
+def enqueue(manifest_path, options: List[str] = []):
+    import job_queue
+    queue = job_queue.JobQueue()
+    for job in read_manifest(manifest_path):
+        job_id = queue.enqueue(job, options)
+        print("Queued job " + str(job_id) + ": " + json.dumps(job))
+
+
+def print_queue():
+    import job_queue
+    for job_id, progress in job_queue.JobQueue().progress().items():
+        print(str(job_id) + " " + json.dumps(progress["job"]) + " " +
+              " ".join(stage + ":" + progress["stages"][stage]["status"] for stage in job_queue.STAGES))
+
+
+# run count worker processes of a kind (network, render or all) until the queue has no more work for them
+def run_workers(kind="all", count=1):
+    import job_queue
+    from multiprocessing import Process
+    if count <= 1:
+        job_queue.run_worker(run_queued_stage, kind, admit=admit_stage)
+        return
+    processes = [Process(target=job_queue.run_worker, args=(
+        run_queued_stage, kind), kwargs={"admit": admit_stage}) for i in range(count)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    options = [arg for arg in sys.argv if arg in VALID_OPTIONS]
+    args = [arg for arg in sys.argv if arg not in VALID_OPTIONS]
+
+    # args[1]: Video Type (or -batch)
+    # args[2]: Action (or the batch manifest)
+    # args[3]: Primary Animal (Or Winner)
+    # args[4+]: Secondary Animals
+
+    print(args)
+    profile = '-profile' in options or '--profile' in options
+    if profile:
+        PROFILER.enable()
+    if len(args) > 2 and args[1] == BATCH_ACTION:
+        run_batch(args[2], options)
+    elif len(args) > 2 and args[1] == ENQUEUE_ACTION:
+        enqueue(args[2], options)
+    elif len(args) > 1 and args[1] == WORKER_ACTION:
+        run_workers(args[2] if len(args) > 2 else "all",
+                    int(args[3]) if len(args) > 3 else 1)
+    elif len(args) > 1 and args[1] == QUEUE_ACTION:
+        print_queue()
+    else:
+        run(args[1:], options)
+    if profile:
+        print("Profile written to " + PROFILER.write())
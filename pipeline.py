@@ -0,0 +1,132 @@
+import hashlib
+import json
+import os
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import List
+from frame_cache import file_hash
+from profiler import PROFILER
+
+PIPELINE_STATE_PATH = "Cache/Pipeline/"
+
+# number of stages run at the same time
+PIPELINE_WORKERS = int(os.environ.get("PIPELINE_WORKERS", 2))
+
+
+class Stage:
+    # run() does the work and returns the paths it wrote. inputs() describes everything else the stage reads.
+    # the outputs of a stage's dependencies are part of its inputs, so a stage reruns when anything upstream changes
+    def __init__(self, name, run, inputs=None, dependencies: List[str] = None, always_run=False):
+        self.name = name
+        self.run = run
+        self.inputs = inputs
+        self.dependencies = dependencies if dependencies is not None else []
+        self.always_run = always_run
+
+
+def output_fingerprints(paths):
+    # content hashes of a stage's outputs, or None if any of them is missing
+    fingerprints = {}
+    for path in paths:
+        if not os.path.exists(path):
+            return None
+        fingerprints[path] = file_hash(path)
+    return fingerprints
+
+
+class Pipeline:
+    # runs stages as soon as their dependencies are done, skipping stages whose inputs and outputs are unchanged since their last run.
+    # the fingerprints of finished stages are saved after each one, so a run after a failure resumes at the failed stage
+    def __init__(self, name, stages: List[Stage], state_path=None):
+        self.name = name
+        self.stages = stages
+        if state_path is None:
+            state_path = PIPELINE_STATE_PATH + \
+                hashlib.sha1(name.encode()).hexdigest() + ".json"
+        self.state_path = state_path
+        self.lock = threading.Lock()
+        self.state = self.load_state()
+
+    def load_state(self):
+        if not os.path.exists(self.state_path):
+            return {}
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except ValueError:
+            return {}
+
+    def save_state(self):
+        directory = os.path.dirname(self.state_path)
+        if directory != "" and not os.path.exists(directory):
+            os.makedirs(directory)
+        temp_path = self.state_path + "." + str(os.getpid()) + ".tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(temp_path, self.state_path)
+
+    def input_fingerprint(self, stage: Stage) -> str:
+        description = {"inputs": stage.inputs() if stage.inputs is not None else None,
+                       "dependencies": {dependency: self.state[dependency]["outputs"] for dependency in stage.dependencies}}
+        return hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    # a stage is up to date if its inputs are unchanged and its outputs still exist. outputs edited by hand are kept,
+    # and count as changed inputs of the stages after it
+    def is_up_to_date(self, stage: Stage, inputs) -> bool:
+        record = self.state.get(stage.name)
+        if stage.always_run or record is None or record["inputs"] != inputs:
+            return False
+        return output_fingerprints(record["output_paths"]) is not None
+
+    def run_stage(self, stage: Stage):
+        with self.lock:
+            inputs = self.input_fingerprint(stage)
+            if self.is_up_to_date(stage, inputs):
+                print(stage.name + " is up to date.")
+                record = self.state[stage.name]
+                outputs = output_fingerprints(record["output_paths"])
+                if outputs != record["outputs"]:
+                    record["outputs"] = outputs
+                    self.save_state()
+                return
+        with PROFILER.stage(stage.name):
+            paths = stage.run()
+        outputs = output_fingerprints(paths)
+        if outputs is None:
+            raise RuntimeError(stage.name + " did not produce " +
+                               ", ".join(path for path in paths if not os.path.exists(path)))
+        with self.lock:
+            self.state[stage.name] = {"inputs": inputs,
+                                      "output_paths": paths, "outputs": outputs}
+            self.save_state()
+
+    def run(self, workers=PIPELINE_WORKERS) -> bool:
+        pending = list(self.stages)
+        done = set()
+        failed = set()
+        futures = {}
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            while len(pending) > 0 or len(futures) > 0:
+                for stage in list(pending):
+                    if any(dependency in failed for dependency in stage.dependencies):
+                        print(stage.name + " skipped because a stage it depends on failed.")
+                        failed.add(stage.name)
+                        pending.remove(stage)
+                    elif all(dependency in done for dependency in stage.dependencies):
+                        futures[executor.submit(self.run_stage, stage)] = stage
+                        pending.remove(stage)
+                if len(futures) == 0:
+                    break
+                (finished, _) = wait(futures, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    stage = futures.pop(future)
+                    try:
+                        future.result()
+                        done.add(stage.name)
+                    except Exception:
+                        traceback.print_exc()
+                        print(stage.name + " failed. Run again to resume from it.")
+                        failed.add(stage.name)
+        # stages left pending depend on a stage that isn't in the pipeline
+        return len(failed) == 0 and len(pending) == 0
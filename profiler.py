@@ -0,0 +1,175 @@
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+PROFILE_PATH = "Profiles/"
+
+
+def read_process_io():
+    # bytes read and written by this process, including pipes (chars) and only storage (bytes). linux only
+    io = {}
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                (key, value) = line.split(":")
+                io[key.strip()] = int(value)
+    except OSError:
+        return {}
+    return {"read_chars": io.get("rchar"), "written_chars": io.get("wchar"),
+            "read_bytes": io.get("read_bytes"), "written_bytes": io.get("write_bytes")}
+
+
+def peak_rss_bytes(who=resource.RUSAGE_SELF) -> int:
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(who).ru_maxrss * 1024
+
+
+class Timing:
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+    def report(self) -> dict:
+        return {"count": self.count, "seconds": round(self.seconds, 6), "max_seconds": round(self.max_seconds, 6),
+                "mean_seconds": round(self.seconds / self.count, 6) if self.count > 0 else None}
+
+
+class RequestTiming(Timing):
+    def __init__(self):
+        super().__init__()
+        self.bytes = 0
+        self.errors = 0
+
+    def report(self) -> dict:
+        report = super().report()
+        report["bytes"] = self.bytes
+        report["errors"] = self.errors
+        return report
+
+
+class Profiler:
+    # collects timings while enabled. every hook is a no-op check when profiling is off
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.start = time.perf_counter()
+        self.io_start = read_process_io()
+        self.stages = []
+        self.timings = {}
+        self.requests = {}
+        self.counters = {}
+
+    def enable(self):
+        self.enabled = True
+        self.reset()
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.stages.append({"stage": name, "start": round(start - self.start, 6),
+                                    "seconds": round(time.perf_counter() - start, 6)})
+
+    # add a duration to a named group of timings, e.g. ("get_frame", "image_fullscreen/still")
+    def add_time(self, group, key, seconds):
+        with self.lock:
+            timings = self.timings.setdefault(group, {})
+            if key not in timings:
+                timings[key] = Timing()
+            timings[key].add(seconds)
+
+    @contextmanager
+    def timed(self, group, key):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(group, key, time.perf_counter() - start)
+
+    def count(self, name, amount=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    # times an outbound request. set record["bytes"] to the size of the response
+    @contextmanager
+    def request(self, service):
+        record = {"bytes": 0}
+        if not self.enabled:
+            yield record
+            return
+        start = time.perf_counter()
+        failed = True
+        try:
+            yield record
+            failed = False
+        finally:
+            with self.lock:
+                if service not in self.requests:
+                    self.requests[service] = RequestTiming()
+                timing = self.requests[service]
+                timing.add(time.perf_counter() - start)
+                timing.bytes += record["bytes"] or 0
+                if failed:
+                    timing.errors += 1
+
+    def report(self) -> dict:
+        seconds = time.perf_counter() - self.start
+        io_end = read_process_io()
+        io = {key: (io_end[key] - self.io_start[key]) if io_end.get(key) is not None and self.io_start.get(key) is not None else None
+              for key in io_end}
+        with self.lock:
+            report = {
+                "seconds": round(seconds, 6),
+                "stages": list(self.stages),
+                "timings": {group: {key: timing.report() for (key, timing) in timings.items()}
+                            for (group, timings) in self.timings.items()},
+                "requests": {service: timing.report() for (service, timing) in self.requests.items()},
+                "counters": dict(self.counters),
+                "peak_rss_bytes": peak_rss_bytes(),
+                # the largest child process, usually ffmpeg
+                "peak_child_rss_bytes": peak_rss_bytes(resource.RUSAGE_CHILDREN),
+                "io": io,
+            }
+        # output frames per second of wall time spent rendering
+        render_seconds = sum(stage["seconds"] for stage in report["stages"]
+                             if stage["stage"] in ["composite", "encode"])
+        if self.counters.get("frames_output") and render_seconds > 0:
+            report["frames_per_second"] = round(
+                self.counters["frames_output"] / render_seconds, 3)
+        return report
+
+    def write(self, path=None) -> str:
+        if path is None:
+            if not os.path.exists(PROFILE_PATH):
+                os.makedirs(PROFILE_PATH)
+            path = PROFILE_PATH + "profile_" + \
+                time.strftime("%Y%m%d_%H%M%S") + ".json"
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+        return path
+
+
+PROFILER = Profiler()
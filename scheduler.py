@@ -0,0 +1,224 @@
+import os
+import sqlite3
+import threading
+import time
+
+SCHEDULER_PATH = os.environ.get("SCHEDULER_PATH", "Cache/providers.db")
+
+# callers waiting for a provider are ignored by other processes if they stop checking in for this long
+WAITER_TIMEOUT = 5
+# longest sleep between checks while waiting for tokens
+WAIT_STEP = 0.5
+# rate limited calls (http 429) are retried this many times, after the provider's Retry-After or RATE_LIMIT_DELAY * 2^attempt seconds
+RATE_LIMIT_RETRIES = int(os.environ.get("RATE_LIMIT_RETRIES", 4))
+RATE_LIMIT_DELAY = 2.0
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+def env_number(name, default):
+    value = os.environ.get(name)
+    if value is None or value == "":
+        return default
+    return float(value)
+
+
+class Provider:
+    # rate (per second) and burst are in the same units as the quota, e.g. requests or characters. quota is per day or month, None for unlimited
+    def __init__(self, name, rate, burst, quota=None, period="day"):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.quota = quota
+        self.period = period
+
+    def period_key(self, now) -> str:
+        # quotas reset at midnight utc
+        if self.period == "month":
+            return time.strftime("%Y-%m", time.gmtime(now))
+        return time.strftime("%Y-%m-%d", time.gmtime(now))
+
+
+# quotas are only enforced when they are configured, e.g. GOOGLE_SEARCH_DAILY_QUOTA=100 for the free custom search tier
+PROVIDERS = {
+    "google_search": Provider("google_search", env_number("GOOGLE_SEARCH_RATE", 1.0), 5,
+                              env_number("GOOGLE_SEARCH_DAILY_QUOTA", None)),
+    # image hosts have no quota, but shouldn't be hit with more than a few requests at a time
+    "image_download": Provider("image_download", env_number("IMAGE_DOWNLOAD_RATE", 8.0), 8),
+    "openai": Provider("openai", env_number("OPENAI_REQUESTS_PER_MINUTE", 20) / 60, 3,
+                       env_number("OPENAI_DAILY_QUOTA", None)),
+    # tts is metered in characters
+    "tts": Provider("tts", env_number("TTS_CHARACTERS_PER_SECOND", 200), 2500,
+                    env_number("TTS_MONTHLY_CHARACTERS", None), "month"),
+}
+
+
+def is_rate_limited(exception) -> bool:
+    if getattr(exception, "code", None) == 429:
+        return True
+    response = getattr(exception, "response", None)
+    if getattr(response, "status_code", None) == 429:
+        return True
+    return type(exception).__name__ == "RateLimitError"
+
+
+def retry_after(exception):
+    headers = getattr(exception, "headers", None)
+    if headers is None:
+        headers = getattr(getattr(exception, "response", None), "headers", None)
+    try:
+        return float(headers.get("Retry-After"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+class ProviderScheduler:
+    # every outbound call goes through here. token buckets, quota counters and waiting callers are kept in a sqlite
+    # database, so every process on the machine shares the same limits. among waiting callers, the highest priority goes first
+    def __init__(self, path=SCHEDULER_PATH, providers=PROVIDERS):
+        self.path = path
+        self.providers = providers
+        # priority of calls made by this process. job runners set it to how far along the current job is
+        self.priority = 0
+        self.connection = None
+        # connections inherited from a parent process. they are kept open, as closing them could touch the parent's locks
+        self.inherited = []
+        self.reset()
+
+    # sqlite connections can't be used across fork(), so a forked process opens its own
+    def reset(self):
+        if self.connection is not None:
+            self.inherited.append(self.connection)
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.connection = None
+
+    def connect(self):
+        if self.connection is None:
+            directory = os.path.dirname(self.path)
+            if directory != "" and not os.path.exists(directory):
+                os.makedirs(directory)
+            self.connection = sqlite3.connect(
+                self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS buckets (provider TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS usage (provider TEXT NOT NULL, period TEXT NOT NULL, used REAL NOT NULL, PRIMARY KEY (provider, period))")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS waiters (id TEXT PRIMARY KEY, provider TEXT NOT NULL, priority REAL NOT NULL, heartbeat REAL NOT NULL)")
+        return self.connection
+
+    def transaction(self, work):
+        if self.pid != os.getpid():
+            self.reset()
+        with self.lock:
+            connection = self.connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                result = work(connection)
+                connection.execute("COMMIT")
+                return result
+            except:
+                connection.execute("ROLLBACK")
+                raise
+
+    def used(self, connection, provider: Provider, now) -> float:
+        row = connection.execute("SELECT used FROM usage WHERE provider = ? AND period = ?",
+                                 (provider.name, provider.period_key(now))).fetchone()
+        return row[0] if row is not None else 0
+
+    # quota left in the current period, or None if the provider has no quota
+    def remaining(self, name):
+        provider = self.providers[name]
+        if provider.quota is None:
+            return None
+        return self.transaction(lambda connection: provider.quota - self.used(connection, provider, time.time()))
+
+    # whether the estimated usage of a job, e.g. {"google_search": 2, "tts": 1200}, fits in what is left of every quota
+    def admit(self, estimates, verbose=True) -> bool:
+        for (name, amount) in estimates.items():
+            remaining = self.remaining(name)
+            if remaining is not None and amount > remaining:
+                if verbose:
+                    print("Not enough " + name + " quota left (" + str(remaining) +
+                          " remaining, " + str(amount) + " needed).")
+                return False
+        return True
+
+    # charge is False for retries of a call whose quota was already charged
+    def try_acquire(self, connection, provider: Provider, cost, priority, waiter, charge=True):
+        now = time.time()
+        if charge and provider.quota is not None:
+            used = self.used(connection, provider, now)
+            if used + cost > provider.quota:
+                connection.execute(
+                    "DELETE FROM waiters WHERE id = ?", (waiter,))
+                raise QuotaExceeded(provider.name + " quota of " + str(provider.quota) + " for " +
+                                    provider.period_key(now) + " is used up (" + str(used) + " used).")
+        row = connection.execute(
+            "SELECT tokens, updated FROM buckets WHERE provider = ?", (provider.name,)).fetchone()
+        tokens = provider.burst
+        if row is not None:
+            tokens = min(provider.burst, row[0] +
+                         (now - row[1]) * provider.rate)
+        higher = connection.execute("SELECT COUNT(*) FROM waiters WHERE provider = ? AND priority > ? AND heartbeat > ? AND id != ?",
+                                    (provider.name, priority, now - WAITER_TIMEOUT, waiter)).fetchone()[0]
+        # calls larger than the bucket go through when it is full, and leave it in debt
+        needed = min(cost, provider.burst)
+        if higher == 0 and tokens >= needed:
+            connection.execute("INSERT OR REPLACE INTO buckets (provider, tokens, updated) VALUES (?, ?, ?)",
+                               (provider.name, tokens - cost, now))
+            if charge:
+                connection.execute("INSERT INTO usage (provider, period, used) VALUES (?, ?, ?) ON CONFLICT (provider, period) DO UPDATE SET used = used + ?",
+                                   (provider.name, provider.period_key(now), cost, cost))
+            connection.execute("DELETE FROM waiters WHERE id = ?", (waiter,))
+            return 0
+        connection.execute("INSERT OR REPLACE INTO buckets (provider, tokens, updated) VALUES (?, ?, ?)",
+                           (provider.name, tokens, now))
+        connection.execute("INSERT OR REPLACE INTO waiters (id, provider, priority, heartbeat) VALUES (?, ?, ?, ?)",
+                           (waiter, provider.name, priority, now))
+        if higher > 0:
+            return WAIT_STEP
+        return (needed - tokens) / provider.rate
+
+    # wait until the provider can take a call of this cost, and charge it to the quota
+    def acquire(self, name, cost=1, priority=None, charge=True):
+        provider = self.providers[name]
+        if priority is None:
+            priority = self.priority
+        waiter = str(os.getpid()) + ":" + str(threading.get_ident())
+        while True:
+            delay = self.transaction(lambda connection: self.try_acquire(
+                connection, provider, cost, priority, waiter, charge))
+            if delay <= 0:
+                return
+            time.sleep(min(delay, WAIT_STEP))
+
+    # empty the provider's bucket, so every process waits before calling it again
+    def back_off(self, name, seconds):
+        provider = self.providers[name]
+        self.transaction(lambda connection: connection.execute("INSERT OR REPLACE INTO buckets (provider, tokens, updated) VALUES (?, ?, ?)",
+                                                               (name, -seconds * provider.rate, time.time())))
+
+    # charge is False when the caller retries a call it was already charged for
+    def call(self, name, function, *args, cost=1, priority=None, charge=True, **kwargs):
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            # the quota is charged once per call. retries only wait for the rate limit
+            self.acquire(name, cost, priority, charge and attempt == 0)
+            try:
+                return function(*args, **kwargs)
+            except Exception as e:
+                if not is_rate_limited(e) or attempt == RATE_LIMIT_RETRIES:
+                    raise
+                delay = retry_after(e)
+                if delay is None:
+                    delay = RATE_LIMIT_DELAY * (2 ** attempt)
+                print(name + " is rate limited, backing off for " +
+                      str(delay) + " seconds.")
+                self.back_off(name, delay)
+
+
+SCHEDULER = ProviderScheduler()
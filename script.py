@@ -1,21 +1,82 @@
-import openai
 import json
+import hashlib
 import os
+import shutil
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 from animal import Animal
+from profiler import PROFILER
+from scheduler import SCHEDULER, QuotaExceeded, is_rate_limited
 from typing import List
-from elevenlabslib import *
 from dotenv import load_dotenv
 
 load_dotenv()
 
-openai.api_key = str(os.environ.get("OPENAI_API_KEY"))
+OPENAI_API_KEY = str(os.environ.get("OPENAI_API_KEY"))
+# when set, completions are requested from this api base instead of OpenAI, e.g. a local stand-in server
+OPENAI_API_BASE = os.environ.get("OPENAI_API_BASE")
 model_engine = "text-davinci-003"
+COMPLETION_PARAMETERS = {"max_tokens": 1024,
+                         "n": 1, "stop": None, "temperature": 0}
+
+# completions are deterministic (temperature 0), so they are cached by model, prompt and parameters
+LLM_CACHE_PATH = "Cache/LLM/"
+# number of scripts generated at the same time in batches
+LLM_CONCURRENCY = int(os.environ.get("LLM_CONCURRENCY", 4))
 
 ELEVENLABS_API_KEY = str(os.environ.get("ELEVENLABS_API_KEY"))
+TTS_VOICE_NAME = "Antoni"
+# when set, narration is requested from this url instead of ElevenLabs, e.g. a local stand-in provider
+TTS_PROVIDER_URL = os.environ.get("TTS_PROVIDER_URL")
+
+# number of lines synthesized at the same time, and how often a failed line is retried
+TTS_CONCURRENCY = int(os.environ.get("TTS_CONCURRENCY", 4))
+TTS_RETRIES = int(os.environ.get("TTS_RETRIES", 3))
+TTS_RETRY_DELAY = float(os.environ.get("TTS_RETRY_DELAY", 1.0))
+# extra settings passed to the voice when generating audio
+TTS_MODEL_SETTINGS = {}
+
+TTS_CACHE_PATH = "Cache/Audio/"
+AUDIO_MANIFEST_FILENAME = "manifest.json"
+
+# provider clients are created on first use, so actions that don't need them never import them or touch the network
+TTS_USER = None
+TTS_VOICE = None
+
+
+def get_openai():
+    import openai
+    openai.api_key = OPENAI_API_KEY
+    if OPENAI_API_BASE is not None:
+        openai.api_base = OPENAI_API_BASE
+    return openai
+
+
+class HttpTTSVoice:
+    # posts the line as plain text and expects the audio bytes back
+    def __init__(self, url):
+        self.url = url
+
+    def generate_audio_bytes(self, line):
+        request = urllib.request.Request(
+            self.url, data=line.encode(), method="POST")
+        with urllib.request.urlopen(request, timeout=60) as response:
+            return response.read()
+
+
+def get_tts_voice():
+    global TTS_USER, TTS_VOICE
+    if TTS_VOICE is None and TTS_PROVIDER_URL is not None:
+        TTS_VOICE = HttpTTSVoice(TTS_PROVIDER_URL)
+    elif TTS_VOICE is None:
+        from elevenlabslib import ElevenLabsUser
+        TTS_USER = ElevenLabsUser(ELEVENLABS_API_KEY)
+        TTS_VOICE = TTS_USER.get_voices_by_name(TTS_VOICE_NAME)[0]
+    return TTS_VOICE
 
-TTS_USER = ElevenLabsUser(ELEVENLABS_API_KEY)
-TTS_VOICE = TTS_USER.get_voices_by_name("Antoni")[0]
 
 FACTS_PROMPT = '''\
 Write a script for a short narrated video called "Five Facts You Didn't Know About the {animal_name}. The format requirements for the script are as follows:
@@ -93,13 +154,13 @@ class ScriptType(Enum):
     FIVE_FACTS = "FACTS"
 
 
-def generate_facts_script(animals: List[Animal]):
+def generate_facts_script(animals: List[Animal], use_cache=True):
     if len(animals) < 1:
         print("No animal provided.")
         return
     animal1 = animals[0]
     prompt = FACTS_PROMPT.format(animal_name=animal1.name)
-    lines = get_chatgpt_response(prompt)
+    lines = get_chatgpt_response(prompt, use_cache)
     write_script_to_file(lines, get_directory_name(
         ScriptType.FIVE_FACTS, animals))
 
@@ -121,13 +182,13 @@ def get_script_audio_path(type: ScriptType, animals: List[Animal]) -> str:
     return get_directory_name(type, animals) + "Audio/"
 
 
-def generate_vs_script(animals: List[Animal], winner: Animal):
+def generate_vs_script(animals: List[Animal], winner: Animal, use_cache=True):
     animal1 = animals[0]
     animal2 = animals[1]
     prompt = VERSUS_PROMPT.format(animal1_name=animal1.name, animal1_weight=animal1.weight, animal1_speed=animal1.speed, animal1_bite=animal1.bite,
                                   animal2_name=animal2.name, animal2_weight=animal2.weight, animal2_speed=animal2.speed, animal2_bite=animal2.bite, winner_name=winner.name)
 
-    lines = get_chatgpt_response(prompt)
+    lines = get_chatgpt_response(prompt, use_cache)
     write_script_to_file(lines, get_directory_name(
         ScriptType.VERSUS, animals))
 
@@ -148,16 +209,56 @@ def read_script_from_file(script_path):
         return json.load(f)
 
 
-def get_chatgpt_response(prompt):
-    completion = openai.Completion.create(
-        engine=model_engine,
-        prompt=prompt,
-        max_tokens=1024,
-        n=1,
-        stop=None,
-        temperature=0
-    )
-    lines = str(completion.choices[0].text).strip().split("\n")
+# generate the scripts for many videos concurrently. jobs are (script type, animals, winner)
+def generate_scripts(jobs, use_cache=True, concurrency=LLM_CONCURRENCY):
+    with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+        futures = []
+        for (type, animals, winner) in jobs:
+            if type == ScriptType.VERSUS:
+                futures.append(executor.submit(
+                    generate_vs_script, animals, winner, use_cache))
+            elif type == ScriptType.FIVE_FACTS:
+                futures.append(executor.submit(
+                    generate_facts_script, animals, use_cache))
+        for future in futures:
+            future.result()
+
+
+def completion_key(model, prompt, parameters) -> str:
+    key = json.dumps({"model": model, "prompt": prompt,
+                     "parameters": parameters}, sort_keys=True)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def get_completion_text(prompt, use_cache=True):
+    cache_path = LLM_CACHE_PATH + \
+        completion_key(model_engine, prompt, COMPLETION_PARAMETERS) + ".json"
+    if use_cache and os.path.exists(cache_path):
+        PROFILER.count("completion_cache_hits")
+        with open(cache_path) as f:
+            return json.load(f)["text"]
+    with PROFILER.request("completion") as record:
+        completion = SCHEDULER.call("openai", get_openai().Completion.create,
+                                    engine=model_engine,
+                                    prompt=prompt,
+                                    **COMPLETION_PARAMETERS
+                                    )
+        text = str(completion.choices[0].text)
+        record["bytes"] = len(text.encode())
+    # write to a temporary file first, so concurrent writers never leave a partial entry
+    if not os.path.exists(LLM_CACHE_PATH):
+        os.makedirs(LLM_CACHE_PATH)
+    temp_path = cache_path + "." + str(os.getpid()) + "." + \
+        str(threading.get_ident()) + ".tmp"
+    with open(temp_path, 'w') as f:
+        json.dump({"model": model_engine, "prompt": prompt,
+                  "parameters": COMPLETION_PARAMETERS, "text": text}, f)
+    os.replace(temp_path, cache_path)
+    return text
+
+
+def get_chatgpt_response(prompt, use_cache=True):
+    lines = get_completion_text(prompt, use_cache).strip().split("\n")
     for line in lines:
         line.strip()
         if line == '':
@@ -165,18 +266,67 @@ def get_chatgpt_response(prompt):
     return lines
 
 
-def download_audio(bytes, script_directory, filename):
-    audio_dir = script_directory + AUDIO_PATH
-    if not os.path.exists(audio_dir):
-        os.makedirs(audio_dir)
-    full_path = audio_dir + filename + ".wav"
-    with open(full_path, mode='bx') as f:
-        f.write(bytes)
+# the voice and model settings narration is synthesized with
+def tts_settings() -> dict:
+    voice = "elevenlabs:" + TTS_VOICE_NAME
+    if TTS_PROVIDER_URL is not None:
+        voice = TTS_PROVIDER_URL
+    return {"voice": voice, "settings": TTS_MODEL_SETTINGS}
+
+
+# narration is stored by a hash of the voice, text and model settings, so identical lines are only synthesized once
+def tts_key(line) -> str:
+    key = json.dumps(dict(tts_settings(), text=line), sort_keys=True)
+    return hashlib.sha256(key.encode()).hexdigest()
+
 
-    print("Successfully Downloaded " + filename)
+def write_atomically(path, bytes):
+    # write to a temporary file first, so a crash never leaves a partial file that looks downloaded
+    temp_path = path + "." + str(os.getpid()) + "." + \
+        str(threading.get_ident()) + ".tmp"
+    with open(temp_path, mode='wb') as f:
+        f.write(bytes)
+    os.replace(temp_path, path)
+
+
+def link_audio(cache_path, full_path):
+    temp_path = full_path + "." + str(os.getpid()) + ".tmp"
+    try:
+        os.link(cache_path, temp_path)
+    except OSError:
+        shutil.copy(cache_path, temp_path)
+    os.replace(temp_path, full_path)
+
+
+def synthesize_line(voice, line, cache_path):
+    for attempt in range(TTS_RETRIES + 1):
+        try:
+            with PROFILER.request("tts") as record:
+                # tts is metered by the character. the line is only charged on its first attempt
+                audio = SCHEDULER.call("tts", voice.generate_audio_bytes, line,
+                                       cost=len(line), charge=attempt == 0, **TTS_MODEL_SETTINGS)
+                record["bytes"] = len(audio)
+            break
+        except Exception as e:
+            # retrying can't help once the quota is used up, and the scheduler already retried rate limits
+            if attempt == TTS_RETRIES or isinstance(e, QuotaExceeded) or is_rate_limited(e):
+                raise
+            delay = TTS_RETRY_DELAY * (2 ** attempt)
+            print("Line \"" + line[:40] + "\" failed (" + repr(e) +
+                  "), retrying in " + str(delay) + " seconds")
+            time.sleep(delay)
+    write_atomically(cache_path, audio)
+
+
+def read_audio_manifest(audio_dir):
+    manifest_path = audio_dir + AUDIO_MANIFEST_FILENAME
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        return json.load(f)
 
 
-def get_tts_audio(script_directory):
+def get_tts_audio(script_directory, voice=None, concurrency=TTS_CONCURRENCY):
     script_path = get_script_path(script_directory)
     print(script_path)
     if not os.path.exists(script_path):
@@ -188,11 +338,71 @@ def get_tts_audio(script_directory):
         print("No script found at " + script_path +
               ". Please create one and try again")
         return
+    audio_dir = script_directory + AUDIO_PATH
+    if not os.path.exists(audio_dir):
+        os.makedirs(audio_dir)
+    if not os.path.exists(TTS_CACHE_PATH):
+        os.makedirs(TTS_CACHE_PATH)
+    # the manifest records which cached line each Audio/ file holds
+    manifest = read_audio_manifest(audio_dir)
+    legacy_manifest = {}
+    keys = {}
     for index, line in enumerate(script):
         filename = str(index)
-        if os.path.exists(script_directory + 'Audio/' + filename + ".wav"):
-            print(
-                "Line " + filename + " of the script is already downloaded. Delete it if you want to regenerate")
-        else:
-            download_audio(TTS_VOICE.generate_audio_bytes(
-                line), script_directory, filename)
+        keys[filename] = tts_key(line)
+        # audio downloaded before there was a manifest is trusted to match this script, but is kept out of the shared
+        # cache, since the script may have been edited since
+        if manifest is None and os.path.exists(audio_dir + filename + ".wav"):
+            legacy_manifest[filename] = keys[filename]
+    if manifest is None:
+        manifest = legacy_manifest
+
+    # only lines that aren't in the cache or already in Audio/ are synthesized, each one once
+    missing = {}
+    for index, line in enumerate(script):
+        key = keys[str(index)]
+        if manifest.get(str(index)) == key and os.path.exists(audio_dir + str(index) + ".wav"):
+            continue
+        if not os.path.exists(TTS_CACHE_PATH + key + ".wav"):
+            missing[key] = line
+    failures = {}
+    if len(missing) > 0:
+        if voice is None:
+            voice = get_tts_voice()
+        # synthesize the lines concurrently. a failed line doesn't stop the others
+        with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+            futures = {}
+            for key, line in missing.items():
+                futures[key] = executor.submit(
+                    synthesize_line, voice, line, TTS_CACHE_PATH + key + ".wav")
+            for key, future in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    failures[key] = e
+
+    # resolve each Audio/ file through the cache
+    failed_lines = []
+    for filename, key in keys.items():
+        full_path = audio_dir + filename + ".wav"
+        if key in failures:
+            failed_lines.append(filename)
+            continue
+        if manifest.get(filename) == key and os.path.exists(full_path):
+            continue
+        link_audio(TTS_CACHE_PATH + key + ".wav", full_path)
+        manifest[filename] = key
+        print("Successfully Downloaded " + filename)
+    # remove audio for lines that were deleted from the script
+    for filename in list(manifest.keys()):
+        if int(filename) >= len(script):
+            if os.path.exists(audio_dir + filename + ".wav"):
+                os.remove(audio_dir + filename + ".wav")
+            del manifest[filename]
+    write_atomically(audio_dir + AUDIO_MANIFEST_FILENAME,
+                     json.dumps(manifest, indent=2).encode())
+
+    if len(failures) > 0:
+        print("Unable to synthesize lines " + ", ".join(failed_lines) +
+              ". Run again to retry them.")
+        raise list(failures.values())[0]
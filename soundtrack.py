@@ -0,0 +1,107 @@
+import hashlib
+import json
+import os
+import wave
+import numpy as np
+from moviepy.editor import AudioFileClip
+from frame_cache import file_hash
+
+SOUNDTRACK_PATH = "Cache/Soundtracks/"
+SOUNDTRACK_FPS = 44100
+
+# background music gain under narration, relative to its normal volume. 1.0 disables ducking
+DUCKING_GAIN = float(os.environ.get("DUCKING_GAIN", 1.0))
+# narration louder than this (peak amplitude over a 50ms window) counts as speech
+DUCKING_THRESHOLD = 0.02
+# how long the music takes to fade down or back up, in seconds
+DUCKING_RAMP = 0.2
+
+if not os.path.exists(SOUNDTRACK_PATH):
+    os.makedirs(SOUNDTRACK_PATH)
+
+
+def read_audio(path, fps=SOUNDTRACK_FPS):
+    clip = AudioFileClip(path, fps=fps)
+    samples = clip.to_soundarray(fps=fps)
+    clip.close()
+    if samples.ndim == 1:
+        samples = samples[:, None]
+    if samples.shape[1] == 1:
+        samples = np.repeat(samples, 2, axis=1)
+    return samples[:, :2].astype(np.float32)
+
+
+def write_wav(path, samples, fps=SOUNDTRACK_FPS):
+    pcm = (np.clip(samples, -1, 1) * 32767).astype("<i2")
+    temp_path = path + "." + str(os.getpid()) + ".tmp"
+    with wave.open(temp_path, 'wb') as f:
+        f.setnchannels(pcm.shape[1])
+        f.setsampwidth(2)
+        f.setframerate(fps)
+        f.writeframes(pcm.tobytes())
+    os.replace(temp_path, path)
+
+
+def smooth(values, width):
+    if width <= 1:
+        return values
+    # centered moving average from a running sum, so the cost doesn't depend on the width
+    padded = np.pad(values, (width // 2, width - width // 2 - 1), mode="edge")
+    cumulative = np.concatenate([[0], np.cumsum(padded, dtype=np.float64)])
+    return ((cumulative[width:] - cumulative[:-width]) / width).astype(np.float32)
+
+
+def speech_mask(narration, fps=SOUNDTRACK_FPS):
+    window = int(fps * 0.05)
+    count = len(narration) // window
+    envelope = np.abs(narration[:count * window]).max(axis=1)
+    loud = envelope.reshape(count, window).max(axis=1) > DUCKING_THRESHOLD
+    mask = np.zeros(len(narration), dtype=np.float32)
+    mask[:count * window] = np.repeat(loud, window)
+    return mask
+
+
+# (path, duration) of each scene's narration, in order. path is None for scenes without audio
+def soundtrack_key(narrations, background_path, volume, fps=SOUNDTRACK_FPS) -> str:
+    description = [[file_hash(path) if path is not None else None, duration] for (path, duration) in narrations]
+    description.append(file_hash(background_path)
+                       if background_path is not None else None)
+    description += [volume, DUCKING_GAIN,
+                    DUCKING_THRESHOLD, DUCKING_RAMP, fps]
+    return hashlib.sha1(json.dumps(description).encode()).hexdigest()
+
+
+def build_soundtrack(narrations, background_path=None, volume=1.0, fps=SOUNDTRACK_FPS) -> str:
+    output_path = SOUNDTRACK_PATH + \
+        soundtrack_key(narrations, background_path, volume, fps) + ".wav"
+    if os.path.exists(output_path):
+        return output_path
+
+    total = int(round(sum(duration for (_, duration) in narrations) * fps))
+    soundtrack = np.zeros((total, 2), dtype=np.float32)
+
+    # place each scene's narration at its offset
+    offset = 0.0
+    for (path, duration) in narrations:
+        start = int(round(offset * fps))
+        offset += duration
+        if path is None:
+            continue
+        samples = read_audio(path, fps)
+        length = min(len(samples), int(round(duration * fps)), total - start)
+        soundtrack[start:start + length] += samples[:length]
+
+    # loop or trim the music to the length of the video, and lower it under narration
+    if background_path is not None:
+        music = read_audio(background_path, fps)
+        if len(music) > 0:
+            music = np.resize(music, (total, 2))
+            gain = np.full(total, volume, dtype=np.float32)
+            if DUCKING_GAIN != 1.0:
+                mask = smooth(speech_mask(soundtrack, fps),
+                              int(DUCKING_RAMP * fps))
+                gain *= 1 - mask * (1 - DUCKING_GAIN)
+            soundtrack += music * gain[:, None]
+
+    write_wav(output_path, soundtrack, fps)
+    return output_path
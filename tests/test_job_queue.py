@@ -0,0 +1,189 @@
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+# run from the project directory: python3 -m pytest tests
+PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_PATH)
+
+import job_queue
+
+# workers are started with spawn, so they read these settings when they import job_queue
+QUEUE_SETTINGS = {"QUEUE_LEASE_SECONDS": "1", "QUEUE_RETRY_DELAY": "0.5",
+                  "QUEUE_MAX_ATTEMPTS": "3", "QUEUE_POLL_INTERVAL": "0.05"}
+# seconds each stage takes, so stages of different jobs overlap between workers
+STAGE_SECONDS = 0.1
+
+
+def execute(log_path, job, stage, options, progress):
+    # stages behave as the job asks: "fail_once" stages fail their first attempt, "always_fail" stages never succeed,
+    # "hang" stages hang on their first attempt, as if the worker froze, and "crash" stages kill their worker every time
+    marker = os.path.dirname(log_path) + "/" + job["name"] + "_" + stage
+    first = not os.path.exists(marker)
+    open(marker, 'a').close()
+    with open(log_path, 'a') as f:
+        f.write(json.dumps({"job": job["name"], "stage": stage, "pid": os.getpid(),
+                            "time": time.time(), "first": first}) + "\n")
+    if stage in job.get("always_fail", []) or (first and stage in job.get("fail_once", [])):
+        raise RuntimeError("failing " + stage)
+    if stage in job.get("crash", []):
+        os._exit(1)
+    if first and stage in job.get("hang", []):
+        time.sleep(60)
+    time.sleep(STAGE_SECONDS)
+
+
+def run_worker(kind, path, log_path):
+    from functools import partial
+    job_queue.run_worker(partial(execute, log_path), kind, path)
+
+
+class JobQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="job_queue") + "/"
+        self.path = self.directory + "queue.db"
+        self.log_path = self.directory + "log.jsonl"
+        self.saved_environ = dict(os.environ)
+        os.environ.update(QUEUE_SETTINGS)
+        self.context = multiprocessing.get_context("spawn")
+        self.queue = job_queue.JobQueue(self.path)
+        self.processes = []
+
+    def tearDown(self):
+        for process in self.processes:
+            if process.is_alive():
+                process.kill()
+            process.join()
+        os.environ.clear()
+        os.environ.update(self.saved_environ)
+        self.queue.connection.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def start_worker(self, kind):
+        process = self.context.Process(
+            target=run_worker, args=(kind, self.path, self.log_path))
+        process.start()
+        self.processes.append(process)
+        return process
+
+    def join(self, processes, timeout=60):
+        for process in processes:
+            process.join(timeout)
+            self.assertFalse(process.is_alive(), "worker did not finish")
+            self.assertEqual(process.exitcode, 0)
+
+    def log(self):
+        with open(self.log_path) as f:
+            return [json.loads(line) for line in f]
+
+    def statuses(self):
+        return {progress["job"]["name"]: {stage: record["status"] for (stage, record) in progress["stages"].items()}
+                for progress in self.queue.progress().values()}
+
+    def test_network_and_render_workers(self):
+        names = ["job" + str(i) for i in range(4)]
+        for name in names:
+            self.queue.enqueue({"name": name})
+        network = [self.start_worker("network") for i in range(2)]
+        render = self.start_worker("render")
+        self.join(network + [render])
+
+        for name in names:
+            self.assertEqual(self.statuses()[name], {
+                             stage: "done" for stage in job_queue.STAGES})
+        log = self.log()
+        network_pids = set(process.pid for process in network)
+        for entry in log:
+            if entry["stage"] == "video":
+                self.assertEqual(entry["pid"], render.pid)
+            else:
+                self.assertIn(entry["pid"], network_pids)
+        # every stage ran once, after the stages it depends on
+        self.assertEqual(len(log), len(names) * len(job_queue.STAGES))
+        times = {(entry["job"], entry["stage"]): entry["time"] for entry in log}
+        for name in names:
+            for (stage, dependencies) in job_queue.STAGE_DEPENDENCIES.items():
+                for dependency in dependencies:
+                    self.assertGreater(
+                        times[(name, stage)], times[(name, dependency)])
+        # both network workers took part
+        self.assertEqual(set(entry["pid"] for entry in log
+                             if entry["stage"] != "video"), network_pids)
+
+    def test_retry_with_backoff(self):
+        self.queue.enqueue({"name": "flaky", "fail_once": ["images"]})
+        self.queue.enqueue({"name": "broken", "always_fail": ["script"]})
+        self.join([self.start_worker("all")])
+
+        statuses = self.statuses()
+        self.assertEqual(statuses["flaky"], {
+                         stage: "done" for stage in job_queue.STAGES})
+        # the broken stage gave up after its attempts, and the stages waiting on it never ran
+        self.assertEqual(statuses["broken"]["script"], "failed")
+        self.assertEqual(statuses["broken"]["audio"], "pending")
+        self.assertEqual(statuses["broken"]["video"], "pending")
+        attempts = [entry["time"] for entry in self.log()
+                    if entry["job"] == "broken" and entry["stage"] == "script"]
+        self.assertEqual(len(attempts), int(QUEUE_SETTINGS["QUEUE_MAX_ATTEMPTS"]))
+        # the wait before each retry doubles
+        delay = float(QUEUE_SETTINGS["QUEUE_RETRY_DELAY"])
+        self.assertGreaterEqual(attempts[1] - attempts[0], delay)
+        self.assertGreaterEqual(attempts[2] - attempts[1], delay * 2)
+        flaky = [entry["time"] for entry in self.log()
+                 if entry["job"] == "flaky" and entry["stage"] == "images"]
+        self.assertEqual(len(flaky), 2)
+        self.assertGreaterEqual(flaky[1] - flaky[0], delay)
+
+    def test_lease_expiry_and_reclaim(self):
+        self.queue.enqueue({"name": "stuck", "hang": ["script"]})
+        frozen = self.start_worker("network")
+        # wait for the worker to hang in the script stage, then kill it without releasing its lease
+        deadline = time.time() + 30
+        while not (os.path.exists(self.log_path) and any(entry["stage"] == "script" for entry in self.log())):
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.05)
+        frozen.kill()
+        frozen.join()
+        self.assertEqual(self.statuses()["stuck"]["script"], "running")
+
+        worker = self.start_worker("all")
+        self.join([worker])
+        self.assertEqual(self.statuses()["stuck"], {
+                         stage: "done" for stage in job_queue.STAGES})
+        script_runs = [entry for entry in self.log()
+                       if entry["stage"] == "script"]
+        self.assertEqual([entry["pid"] for entry in script_runs], [
+                         frozen.pid, worker.pid])
+        # the expired lease counted as an attempt
+        self.assertEqual(self.queue.progress()[1]["stages"]["script"]["attempts"], 1)
+
+    def test_expired_leases_give_up(self):
+        self.queue.enqueue({"name": "crashing", "crash": ["script"]})
+        # every worker dies in the script stage, so keep starting new ones until the stage gives up
+        workers = []
+        while self.statuses()["crashing"]["script"] != "failed":
+            self.assertLess(len(workers), 10, "the stage was never given up")
+            workers.append(self.start_worker("all"))
+            workers[-1].join(60)
+            self.assertFalse(workers[-1].is_alive(), "worker did not finish")
+
+        statuses = self.statuses()["crashing"]
+        self.assertEqual(statuses["audio"], "pending")
+        self.assertEqual(statuses["video"], "pending")
+        attempts = [entry["time"] for entry in self.log()
+                    if entry["stage"] == "script"]
+        self.assertEqual(len(attempts), int(QUEUE_SETTINGS["QUEUE_MAX_ATTEMPTS"]))
+        # each retry waits for the lease to expire and then backs off like a failure
+        lease = float(QUEUE_SETTINGS["QUEUE_LEASE_SECONDS"])
+        delay = float(QUEUE_SETTINGS["QUEUE_RETRY_DELAY"])
+        self.assertGreaterEqual(attempts[1] - attempts[0], lease + delay)
+        self.assertGreaterEqual(attempts[2] - attempts[1], lease + delay * 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
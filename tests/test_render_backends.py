@@ -0,0 +1,89 @@
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+# run from the project directory: python3 -m pytest tests
+PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_PATH)
+sys.path.insert(0, PROJECT_PATH + "/benchmarks")
+
+import frame_cache
+import soundtrack
+import video
+from filter_graph import FFMPEG_BINARY
+
+try:
+    import render as benchmark
+    from moviepy.editor import AudioFileClip
+except ImportError:
+    benchmark = None
+
+# small videos with the shortest benchmark narration, so both backends render quickly
+SCALE = 0.25
+FPS = 30
+
+
+def ffmpeg_available() -> bool:
+    try:
+        subprocess.run([FFMPEG_BINARY, "-version"], capture_output=True)
+        return True
+    except OSError:
+        return False
+
+
+def count_frames(path) -> int:
+    result = subprocess.run([FFMPEG_BINARY, "-i", path, "-map", "0:v", "-f", "null", "-"],
+                            capture_output=True, text=True, check=True)
+    return int(re.findall(r"frame=\s*(\d+)", result.stderr)[-1])
+
+
+@unittest.skipIf(benchmark is None or not ffmpeg_available(), "moviepy or ffmpeg is not installed")
+class RenderBackendsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="render_backends") + "/"
+        benchmark.make_fixtures(self.directory)
+        self.saved_directory = os.getcwd()
+        os.chdir(self.directory)
+        # the modules create their folders when they are imported, in the project directory
+        for path in [video.VIDEO_OUTPUT_PATH, video.SEGMENT_CACHE_PATH, soundtrack.SOUNDTRACK_PATH,
+                     frame_cache.FRAME_CACHE_PATH]:
+            os.makedirs(path, exist_ok=True)
+
+    def tearDown(self):
+        os.chdir(self.saved_directory)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def render(self, template_name, backend):
+        template = getattr(video, template_name).scaled(SCALE)
+        template = template.set_background_audio(
+            AudioFileClip("BackgroundMusic/music.wav"))
+        scene_seconds = min(benchmark.SCENE_SECONDS)
+        audio_count = len(
+            [scene for scene in template.scenes if scene.has_audio])
+        audio_clips = [AudioFileClip("Narration/" + str(scene_seconds) + "_" + str(i) + ".wav")
+                       for i in range(audio_count)]
+        paths = []
+        for i in range(8):
+            for animal_name in benchmark.FIXTURE_ANIMALS:
+                paths.append("Assets/" + animal_name +
+                             "/Active/" + str(i) + ".jpg")
+        output_path = template.render(paths, audio_clips, "Output/" + template_name + "_" + backend.value + ".mp4",
+                                      fps=FPS, backend=backend)[0]
+        return (count_frames(output_path), video.frame_count(template.build(paths, audio_clips).duration, FPS))
+
+    def test_same_frame_count(self):
+        for template_name in ["ANIMAL_VERSUS_VIDEO", "FACTS_VIDEO"]:
+            (ffmpeg_frames, expected) = self.render(
+                template_name, video.RenderBackend.FFMPEG)
+            (moviepy_frames, expected) = self.render(
+                template_name, video.RenderBackend.MOVIEPY)
+            self.assertEqual(ffmpeg_frames, moviepy_frames, template_name)
+            self.assertEqual(ffmpeg_frames, expected, template_name)
+
+
+if __name__ == "__main__":
+    unittest.main()
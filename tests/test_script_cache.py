@@ -0,0 +1,124 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# run from the project directory: python3 -m pytest tests
+PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_PATH)
+
+import animal
+import script
+from scheduler import ProviderScheduler, Provider
+
+try:
+    import openai
+except ImportError:
+    openai = None
+
+# seconds the stand-in server takes to answer, so concurrent requests overlap
+RESPONSE_DELAY = 0.2
+
+
+class CompletionServer(ThreadingHTTPServer):
+    # a local stand-in for the completions api. it answers every prompt with six numbered lines and counts requests
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), CompletionHandler)
+        self.lock = threading.Lock()
+        self.prompts = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+
+class CompletionHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        request = json.loads(self.rfile.read(
+            int(self.headers["Content-Length"])))
+        server = self.server
+        with server.lock:
+            server.prompts.append(request["prompt"])
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        time.sleep(RESPONSE_DELAY)
+        with server.lock:
+            server.in_flight -= 1
+        text = "\n\n".join("Line " + str(i) for i in range(1, 7)) + "\n"
+        body = json.dumps({"id": "cmpl-test", "object": "text_completion", "created": int(time.time()), "model": script.model_engine,
+                           "choices": [{"text": text, "index": 0, "logprobs": None, "finish_reason": "stop"}]}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@unittest.skipIf(openai is None, "the openai package is not installed")
+class ScriptCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.server = CompletionServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.directory = tempfile.mkdtemp(prefix="script_cache") + "/"
+        self.saved = (script.OPENAI_API_BASE, script.LLM_CACHE_PATH,
+                      script.SCRIPTS_PATH, script.SCHEDULER, openai.api_base)
+        script.OPENAI_API_BASE = "http://127.0.0.1:" + \
+            str(self.server.server_port) + "/v1"
+        script.LLM_CACHE_PATH = self.directory + "LLM/"
+        script.SCRIPTS_PATH = self.directory + "Scripts/"
+        # a scheduler of its own, so the test neither waits for nor charges the real provider limits
+        script.SCHEDULER = ProviderScheduler(self.directory + "providers.db",
+                                             {"openai": Provider("openai", 1000, 1000)})
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        (script.OPENAI_API_BASE, script.LLM_CACHE_PATH,
+         script.SCRIPTS_PATH, script.SCHEDULER, openai.api_base) = self.saved
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def read_script(self, script_type, animals):
+        return script.read_script_from_file(script.get_script_path(
+            script.get_directory_name(script_type, animals)))
+
+    def test_cache_hit(self):
+        animals = [animal.get_animal("Tiger")]
+        script.generate_facts_script(animals)
+        script.generate_facts_script(animals)
+        self.assertEqual(len(self.server.prompts), 1)
+        self.assertEqual(self.read_script(script.ScriptType.FIVE_FACTS, animals),
+                         ["Line " + str(i) for i in range(1, 7)])
+
+    def test_nocache_bypass(self):
+        animals = [animal.get_animal("Lion")]
+        script.generate_facts_script(animals)
+        script.generate_facts_script(animals, use_cache=False)
+        self.assertEqual(len(self.server.prompts), 2)
+        # the bypass still refreshes the cache
+        script.generate_facts_script(animals)
+        self.assertEqual(len(self.server.prompts), 2)
+
+    def test_concurrent_batch(self):
+        names = ["Tiger", "Lion", "Hippo", "Moose"]
+        jobs = [(script.ScriptType.FIVE_FACTS, [animal.get_animal(name)], animal.get_animal(name))
+                for name in names]
+        jobs.append((script.ScriptType.VERSUS, [animal.get_animal("Tiger"), animal.get_animal("Lion")],
+                     animal.get_animal("Tiger")))
+        script.generate_scripts(jobs, concurrency=4)
+        self.assertEqual(len(self.server.prompts), len(jobs))
+        self.assertGreater(self.server.max_in_flight, 1)
+        for (script_type, animals, winner) in jobs:
+            self.assertEqual(len(self.read_script(script_type, animals)), 6)
+        # a second batch is served from the cache
+        script.generate_scripts(jobs, concurrency=4)
+        self.assertEqual(len(self.server.prompts), len(jobs))
+
+
+if __name__ == "__main__":
+    unittest.main()
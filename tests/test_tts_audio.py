@@ -0,0 +1,174 @@
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# run from the project directory: python3 -m pytest tests
+PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_PATH)
+
+import script
+from scheduler import ProviderScheduler, Provider
+
+# seconds the stand-in server takes to answer, so concurrent requests overlap
+RESPONSE_DELAY = 0.2
+
+
+def audio_bytes(line) -> bytes:
+    return b"RIFF" + line.encode()
+
+
+class TTSServer(ThreadingHTTPServer):
+    # a local stand-in for the tts provider. it answers each line with fake audio, counts requests, and fails the
+    # lines in failures: "error" lines get a server error, "truncate" lines get half of their audio before the
+    # connection closes. failures maps each line to how it fails and how many more times
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), TTSHandler)
+        self.lock = threading.Lock()
+        self.lines = []
+        self.failures = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+
+class TTSHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        line = self.rfile.read(int(self.headers["Content-Length"])).decode()
+        server = self.server
+        with server.lock:
+            server.lines.append(line)
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            failure = None
+            if server.failures.get(line, (None, 0))[1] > 0:
+                (failure, count) = server.failures[line]
+                server.failures[line] = (failure, count - 1)
+        time.sleep(RESPONSE_DELAY)
+        with server.lock:
+            server.in_flight -= 1
+        if failure == "error":
+            self.send_error(500)
+            return
+        body = audio_bytes(line)
+        self.send_response(200)
+        self.send_header("Content-Type", "audio/wav")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if failure == "truncate":
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TTSAudioTest(unittest.TestCase):
+    def setUp(self):
+        self.server = TTSServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.directory = tempfile.mkdtemp(prefix="tts_audio") + "/"
+        self.saved = (script.TTS_PROVIDER_URL, script.TTS_VOICE, script.TTS_CACHE_PATH,
+                      script.SCRIPTS_PATH, script.SCHEDULER, script.TTS_RETRY_DELAY)
+        script.TTS_PROVIDER_URL = "http://127.0.0.1:" + \
+            str(self.server.server_port) + "/tts"
+        script.TTS_VOICE = None
+        script.TTS_CACHE_PATH = self.directory + "Audio/"
+        script.SCRIPTS_PATH = self.directory + "Scripts/"
+        script.TTS_RETRY_DELAY = 0.05
+        # a scheduler of its own, so the test neither waits for nor charges the real provider limits
+        script.SCHEDULER = ProviderScheduler(self.directory + "providers.db",
+                                             {"tts": Provider("tts", 100000, 100000)})
+        self.script_directory = script.SCRIPTS_PATH + "VS_Test/"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        (script.TTS_PROVIDER_URL, script.TTS_VOICE, script.TTS_CACHE_PATH,
+         script.SCRIPTS_PATH, script.SCHEDULER, script.TTS_RETRY_DELAY) = self.saved
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def write_script(self, lines):
+        script.write_script_to_file(lines, self.script_directory)
+
+    def read_audio(self, index) -> bytes:
+        with open(self.script_directory + script.AUDIO_PATH + str(index) + ".wav", 'rb') as f:
+            return f.read()
+
+    def audio_files(self):
+        files = []
+        for directory in [script.TTS_CACHE_PATH, self.script_directory + script.AUDIO_PATH]:
+            files += [directory + name for name in os.listdir(directory)
+                      if name != script.AUDIO_MANIFEST_FILENAME]
+        return files
+
+    def test_concurrency_cap(self):
+        lines = ["Line " + str(i) for i in range(8)]
+        self.write_script(lines)
+        script.get_tts_audio(self.script_directory, concurrency=3)
+        self.assertEqual(sorted(self.server.lines), sorted(lines))
+        self.assertGreater(self.server.max_in_flight, 1)
+        self.assertLessEqual(self.server.max_in_flight, 3)
+        for (index, line) in enumerate(lines):
+            self.assertEqual(self.read_audio(index), audio_bytes(line))
+
+    def test_retry_after_transient_failure(self):
+        lines = ["Steady line", "Flaky line", "Cut off line"]
+        self.server.failures = {"Flaky line": ("error", 1),
+                                "Cut off line": ("truncate", 1)}
+        self.write_script(lines)
+        script.get_tts_audio(self.script_directory)
+        self.assertEqual(self.server.lines.count("Steady line"), 1)
+        self.assertEqual(self.server.lines.count("Flaky line"), 2)
+        self.assertEqual(self.server.lines.count("Cut off line"), 2)
+        for (index, line) in enumerate(lines):
+            self.assertEqual(self.read_audio(index), audio_bytes(line))
+
+    def test_no_partial_audio_after_failure(self):
+        lines = ["Good line", "Broken line", "Truncated line"]
+        # both lines fail every attempt
+        self.server.failures = {"Broken line": ("error", 100),
+                                "Truncated line": ("truncate", 100)}
+        self.write_script(lines)
+        with self.assertRaises(Exception):
+            script.get_tts_audio(self.script_directory)
+        self.assertEqual(self.server.lines.count(
+            "Broken line"), script.TTS_RETRIES + 1)
+        # only the good line has audio, and no temporary files are left behind
+        self.assertEqual(self.read_audio(0), audio_bytes("Good line"))
+        self.assertEqual(sorted(os.path.basename(path) for path in self.audio_files()),
+                         sorted(["0.wav", script.tts_key("Good line") + ".wav"]))
+
+        # once the provider recovers, the next run synthesizes only the failed lines
+        self.server.failures = {}
+        del self.server.lines[:]
+        script.get_tts_audio(self.script_directory)
+        self.assertEqual(sorted(self.server.lines), [
+                         "Broken line", "Truncated line"])
+        for (index, line) in enumerate(lines):
+            self.assertEqual(self.read_audio(index), audio_bytes(line))
+
+    def test_edit_resynthesizes_changed_line(self):
+        lines = ["First line", "Second line", "Third line"]
+        self.write_script(lines)
+        script.get_tts_audio(self.script_directory)
+        self.assertEqual(len(self.server.lines), 3)
+
+        lines[1] = "Second line, edited"
+        self.write_script(lines)
+        script.get_tts_audio(self.script_directory)
+        self.assertEqual(self.server.lines[3:], ["Second line, edited"])
+        for (index, line) in enumerate(lines):
+            self.assertEqual(self.read_audio(index), audio_bytes(line))
+        # running again with nothing changed synthesizes nothing
+        script.get_tts_audio(self.script_directory)
+        self.assertEqual(len(self.server.lines), 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
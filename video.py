@@ -3,10 +3,21 @@ import moviepy.video.fx.all as vfx
 import moviepy.audio.fx.all as afx
 import script
 import random
+import bisect
+import numpy as np
+import hashlib
+import time
+from concurrent.futures import ProcessPoolExecutor
 from animal import Animal
 from enum import Enum
 from typing import List
-from copy import deepcopy
+from copy import copy
+from frame_cache import FRAME_CACHE, frame_key, file_hash
+import ffmpeg_render
+import asset_index
+import soundtrack
+import encoder
+from profiler import PROFILER
 
 # region Paths
 
@@ -17,6 +28,8 @@ VIDEO_OUTPUT_PATH = "Output/"
 ASSET_PATH = "Assets/"
 ACTIVE_PATH = "Active/"
 
+SEGMENT_CACHE_PATH = "Cache/Segments/"
+
 if not os.path.exists(BACKGROUND_MUSIC_PATH):
     os.makedirs(BACKGROUND_MUSIC_PATH)
 
@@ -25,8 +38,15 @@ if not os.path.exists(VIDEO_OUTPUT_PATH):
 
 if not os.path.exists(ASSET_PATH):
     os.makedirs(ASSET_PATH)
+
+if not os.path.exists(SEGMENT_CACHE_PATH):
+    os.makedirs(SEGMENT_CACHE_PATH)
 # endregion
 
+TRANSITION_DURATION = 0.15
+
+BACKGROUND_MUSIC_VOLUME = 0.10
+
 
 class ClipSize(Enum):
     FULLSCREEN = 0
@@ -39,81 +59,118 @@ class ClipStyle(Enum):
     VIDEO = 1
 
 
+class RenderBackend(Enum):
+    MOVIEPY = "moviepy"
+    FFMPEG = "ffmpeg"
+    # each scene is rendered by MoviePy in its own process, then the segments are joined without re-encoding
+    PARALLEL = "parallel"
+
+
+RENDER_BACKEND = RenderBackend(os.environ.get("RENDER_BACKEND", "moviepy"))
+
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", os.cpu_count() or 1))
+
+
+class RenderQuality:
+    # scale is relative to the template's size. overlays are scaled with the video, and timing is the same at every quality
+    def __init__(self, name, scale=1.0, fps=30, preset="medium"):
+        self.name = name
+        self.scale = scale
+        self.fps = fps
+        self.preset = preset
+
+
+FINAL_QUALITY = RenderQuality("final")
+
+# a quick draft for reviewing scripts and image choices before the final render
+PREVIEW_QUALITY = RenderQuality("preview", float(os.environ.get("PREVIEW_SCALE", 0.5)),
+                                int(os.environ.get("PREVIEW_FPS", 15)), "ultrafast")
+
+
 class ClipTransition(Enum):
     CROSSFADE_IN = 0,
     CROSSFADE_OUT = 0
 
 
+# templates are immutable. the builder methods return a modified copy that shares everything else, including overlays, with the original
 class ClipFormat:
-    def __init__(self, style: ClipStyle = ClipStyle.IMAGE, size: ClipSize = ClipSize.FULLSCREEN, assets=1, duration=None, overlays: List[ImageClip] = [], path_override=None, transitions: List[ClipTransition] = [ClipTransition.CROSSFADE_IN, ClipTransition.CROSSFADE_OUT]):
+    def __init__(self, style: ClipStyle = ClipStyle.IMAGE, size: ClipSize = ClipSize.FULLSCREEN, assets=1, duration=None, overlays: List[ImageClip] = None, path_override=None, transitions: List[ClipTransition] = None):
+        if overlays is None:
+            overlays = []
+        if transitions is None:
+            transitions = [ClipTransition.CROSSFADE_IN,
+                           ClipTransition.CROSSFADE_OUT]
         self.style = style
         self.size = size
         self.assets = assets
         self.duration = duration
-        self.overlays = overlays
+        self.overlays = tuple(overlays)
         self.path_override = path_override
-        self.transitions = transitions
+        self.transitions = tuple(transitions)
 
     def new(self):
-        new = deepcopy(self)
-        return new
+        return copy(self)
 
     def add_overlay(self, overlay):
-        self.overlays.append(overlay)
-        return self
+        new = copy(self)
+        new.overlays = self.overlays + (overlay,)
+        return new
 
     def set_transitions(self, transitions):
-        self.transitions = transitions
-        return self
+        new = copy(self)
+        new.transitions = tuple(transitions)
+        return new
 
     def set_override(self, path):
-        self.path_override = path
-        return self
+        new = copy(self)
+        new.path_override = path
+        return new
 
     def set_duration(self, duration):
-        self.duration = duration
-        return self
+        new = copy(self)
+        new.duration = duration
+        return new
+
+    def crop_size(self, video_height=1280, video_width=720):
+        if self.size == ClipSize.VERTICALSPLITSCREEN:
+            return (video_width, video_height / self.assets)
+        elif self.size == ClipSize.HORIZONTALSPLITSCREEN:
+            return (video_width / self.assets, video_height)
+        return (video_width, video_height)
+
+    # the asset path used for each asset slot of the clip
+    def asset_paths(self, paths):
+        if self.path_override is not None:
+            return [self.path_override] * self.assets
+        return paths[:self.assets]
 
-    def format_clip(self, paths, duration, video_height=1280, video_width=720):
+    def format_clip(self, paths, duration, video_height=1280, video_width=720, scale=1.0):
         clips = []
-        path_counter = 0
+        (crop_width, crop_height) = self.crop_size(video_height, video_width)
         # get the assets from paths according to number of assets needed for clip and turn into a array of clips with calculated height and width
-        for i in range(self.assets):
+        for path in self.asset_paths(paths):
             try:
                 clip = None
-                if self.path_override is None:
-                    if self.style == ClipStyle.IMAGE:
-                        clip = ImageClip(paths[path_counter])
-                    elif self.style == ClipStyle.VIDEO:
-                        clip = VideoClip(paths[path_counter])
-                else:
-                    if self.style == ClipStyle.IMAGE:
-                        clip = ImageClip(self.path_override)
-                    elif self.style == ClipStyle.VIDEO:
-                        clip = VideoClip(self.path_override)
-
-                # resize
-                clip = clip.resize(height=video_height)
-                (w, h) = clip.size
-
-                # resize clip according to specified size
-                if self.size == ClipSize.VERTICALSPLITSCREEN:
-                    clip = clip.fx(vfx.crop, x_center=w/2, y_center=h/2,
-                                   width=video_width, height=video_height / self.assets)
-                elif self.size == ClipSize.FULLSCREEN:
-                    clip = clip.fx(vfx.crop, x_center=w/2, y_center=h/2,
-                                   width=video_width, height=video_height)
-                elif self.size == ClipSize.HORIZONTALSPLITSCREEN:
+                if self.style == ClipStyle.IMAGE:
+                    # still images are decoded, resized and cropped once and then served from the frame cache
+                    clip = ImageClip(load_image_frame(
+                        path, self.size, video_height, crop_width, crop_height))
+                elif self.style == ClipStyle.VIDEO:
+                    clip = VideoClip(path)
+                    # resize
+                    clip = clip.resize(height=video_height)
+                    (w, h) = clip.size
+                    # crop clip according to specified size
                     clip = clip.fx(vfx.crop, x_center=w/2, y_center=h/2,
-                                   width=video_width / self.assets, height=video_height)
+                                   width=crop_width, height=crop_height)
 
                 clips.append(clip)
             except:
-                print("Unable to open" + paths[path_counter] + ".")
-            # increment path counter to grab next asset supplied. if not enough were supplied, begin to reuse assets.
-            path_counter += 1
-            if path_counter > (self.assets - 1):
-                path_counter = 0
+                print("Unable to open" + path + ".")
+
+        if len(clips) == 0:
+            raise ValueError("None of the assets for this clip could be opened: " +
+                             ", ".join(self.asset_paths(paths)))
 
         # build clip according to style
         final_clip = None
@@ -127,17 +184,21 @@ class ClipFormat:
         elif self.size == ClipSize.HORIZONTALSPLITSCREEN:
             final_clip = clips_array(clips)
 
-        # apply overlays
-        for overlay in self.overlays:
-            final_clip = CompositeVideoClip([final_clip, overlay])
+        # apply overlays. still images are composited once into a single frame instead of on every frame
+        overlays = overlay_clips(self.overlays, scale)
+        if is_static(final_clip, overlays):
+            final_clip = flatten_clip(final_clip, overlays)
+        else:
+            for overlay in overlays:
+                final_clip = CompositeVideoClip([final_clip, overlay])
 
         final_clip = final_clip.set_duration(duration)
         # apply transitions
         for transition in self.transitions:
             if transition == ClipTransition.CROSSFADE_IN:
-                final_clip = final_clip.crossfadein(0.15)
+                final_clip = final_clip.crossfadein(TRANSITION_DURATION)
             elif transition == ClipTransition.CROSSFADE_OUT:
-                final_clip = final_clip.crossfadeout(0.15)
+                final_clip = final_clip.crossfadeout(TRANSITION_DURATION)
 
         # apply duration
         if self.duration is not None:
@@ -146,32 +207,73 @@ class ClipFormat:
         return final_clip
 
 
+def load_image_frame(path, clip_size: ClipSize, video_height, crop_width, crop_height):
+    key = frame_key(path, video_height,
+                    (crop_width, crop_height), clip_size)
+    frame = FRAME_CACHE.get(key)
+    if frame is None:
+        clip = ImageClip(path).resize(height=video_height)
+        (w, h) = clip.size
+        clip = clip.fx(vfx.crop, x_center=w/2, y_center=h/2,
+                       width=crop_width, height=crop_height)
+        frame = FRAME_CACHE.put(key, clip.get_frame(0))
+    return frame
+
+
+def is_static(clip, overlays: List[ImageClip] = []) -> bool:
+    # a clip is static if every layer of it is a still image
+    layers = [clip] + list(overlays)
+    for layer in layers:
+        if isinstance(layer, CompositeVideoClip):
+            if not is_static(layer.clips[0], layer.clips[1:]):
+                return False
+        elif not isinstance(layer, ImageClip):
+            return False
+    return True
+
+
+def flatten_clip(clip, overlays: List[ImageClip] = []):
+    # composite the clip and its overlays once, and hold the resulting frame
+    if len(overlays) > 0:
+        clip = CompositeVideoClip([clip] + list(overlays))
+    return ImageClip(clip.get_frame(0))
+
+
 def with_duration(clip_format: ClipFormat, duration):
     return clip_format.set_duration(duration)
 
 
 class Scene:
-    def __init__(self, clip_formats: List[ClipFormat] = [], overlays: List[ImageClip] = [], has_audio=True):
-        self.clip_formats = clip_formats
-        self.overlays = overlays
+    def __init__(self, clip_formats: List[ClipFormat] = None, overlays: List[ImageClip] = None, has_audio=True):
+        if clip_formats is None:
+            clip_formats = []
+        if overlays is None:
+            overlays = []
+        self.clip_formats = tuple(clip_formats)
+        self.overlays = tuple(overlays)
         self.assets = 0
         self.has_audio = has_audio
         for format in clip_formats:
             self.assets += format.assets
 
     def new(self):
-        new = deepcopy(self)
-        return new
+        return copy(self)
 
     def add_overlay(self, overlay):
-        self.overlays.append(overlay)
-        return self
+        new = copy(self)
+        new.overlays = self.overlays + (overlay,)
+        return new
 
-    # duration should usually be equal to audio length if it exists
-    def build(self, paths, duration, audio=None, video_height=1280, video_width=720):
+    def set_clip_format(self, index, clip_format: ClipFormat):
+        clip_formats = list(self.clip_formats)
+        clip_formats[index] = clip_format
+        return Scene(clip_formats, self.overlays, self.has_audio)
+
+    # assign each clip format its paths and duration. duration should usually be equal to audio length if it exists
+    def plan(self, paths, duration):
         # build scene alternating paths, repeat if you run out
         path_counter = 0
-        clips = []
+        clip_plans: List[ClipPlan] = []
         time_remaining_for_clips = duration
         untimed_clips = len(self.clip_formats)
         # calculate time remaining for clips that need to be dynamically assigned durations
@@ -180,7 +282,7 @@ class Scene:
                 time_remaining_for_clips = time_remaining_for_clips - clip_format.duration
                 untimed_clips -= 1
 
-        # build each clip in the scene
+        # plan each clip in the scene
         for clip_format in self.clip_formats:
             # number of paths needed for the clip
             path_count = clip_format.assets
@@ -192,11 +294,8 @@ class Scene:
             if clip_format.duration is None:
                 clip_duration = time_remaining_for_clips / untimed_clips
 
-            # build clip
-            clip = clip_format.format_clip(
-                paths[path_counter: path_counter + path_count], clip_duration, video_height, video_width)
-
-            clips.append(clip)
+            clip_plans.append(ClipPlan(
+                clip_format, paths[path_counter: path_counter + path_count], clip_duration))
             # update path counter
             path_counter += path_count
 
@@ -204,47 +303,233 @@ class Scene:
             if path_counter > len(paths) - 1:
                 path_counter = 0
 
-        scene = concatenate(clips, method="compose")
+        return clip_plans
 
-        # apply overlays
-        for overlay in self.overlays:
-            scene = CompositeVideoClip(scene, overlay)
+    def build(self, paths, duration, audio=None, video_height=1280, video_width=720):
+        return self.build_plan(self.plan(paths, duration), audio, video_height, video_width)
+
+    def build_plan(self, clip_plans, audio=None, video_height=1280, video_width=720):
+        timeline = Timeline((video_width, video_height))
+        self.add_to_timeline(timeline, clip_plans, video_height, video_width)
+        scene = timeline.clip()
 
         # if audio exists, apply it
 
         scene.audio = audio
 
-        scene.set_duration(audio.duration)
-
         return scene
 
+    def add_to_timeline(self, timeline, clip_plans, video_height=1280, video_width=720, scale=1.0):
+        # build each clip in the scene. scene overlays are drawn over each clip, above its transitions
+        overlays = overlay_clips(self.overlays, scale)
+        for clip_plan in clip_plans:
+            timeline.add(clip_plan.clip_format.format_clip(
+                clip_plan.paths, clip_plan.duration, video_height, video_width, scale), clip_plan.clip_format, overlays)
+
+
+class TimelineEntry:
+    def __init__(self, clip, start, overlays: List[ImageClip], static_start=None, static_end=None, kind="clip", scene=0):
+        self.clip = clip
+        self.start = start
+        # the clip's style and size, and the index of its scene, for profiling
+        self.kind = kind
+        self.scene = scene
+        self.end = start + clip.duration
+        self.overlays = overlays
+        # the part of the clip, in clip time, where every frame is the same
+        self.static_start = static_start
+        self.static_end = static_end
+        self.static_frame = None
+
+    def is_static(self, t) -> bool:
+        return self.static_start is not None and self.static_start <= t < self.static_end
+
+
+class Timeline:
+    # clips of a video flattened into sorted, back to back intervals with precomputed offsets.
+    # a frame lookup is a binary search that only touches the clip that is active at that time
+    def __init__(self, size, overlays: List[ImageClip] = []):
+        self.size = size
+        self.overlays = list(overlays)
+        self.starts = []
+        self.entries: List[TimelineEntry] = []
+        self.duration = 0
+        # scene of the clips being added
+        self.scene = 0
+        (w, h) = size
+        self.background = np.zeros((h, w, 3), dtype=np.uint8)
+
+    def add(self, clip, clip_format: ClipFormat = None, overlays: List[ImageClip] = []):
+        static_start = None
+        static_end = None
+        layers = [clip] + list(overlays)
+        if clip_format is not None and all(isinstance(layer, ImageClip) for layer in layers):
+            # still clips only change inside their transitions
+            static_start = 0
+            static_end = clip.duration
+            if ClipTransition.CROSSFADE_IN in clip_format.transitions:
+                static_start = TRANSITION_DURATION
+            if ClipTransition.CROSSFADE_OUT in clip_format.transitions:
+                static_end = clip.duration - TRANSITION_DURATION
+        self.starts.append(self.duration)
+        kind = "clip"
+        if clip_format is not None:
+            kind = clip_format.style.name.lower() + "_" + clip_format.size.name.lower()
+        self.entries.append(TimelineEntry(clip.set_position("center"), self.duration, list(overlays),
+                                          static_start, static_end, kind, self.scene))
+        self.duration += clip.duration
+        return self
+
+    def entry_index(self, t) -> int:
+        index = bisect.bisect_right(self.starts, t) - 1
+        return min(max(index, 0), len(self.entries) - 1)
+
+    def entry(self, t) -> TimelineEntry:
+        return self.entries[self.entry_index(t)]
+
+    def get_frame(self, t):
+        entry = self.entry(t)
+        local_t = t - entry.start
+        if not PROFILER.enabled:
+            return self.entry_frame(entry, local_t)
+        start = time.perf_counter()
+        frame = self.entry_frame(entry, local_t)
+        seconds = time.perf_counter() - start
+        PROFILER.add_time("get_frame", entry.kind +
+                          ("/still" if entry.is_static(local_t) else "/composited"), seconds)
+        PROFILER.add_time("scene_frames", str(entry.scene), seconds)
+        return frame
+
+    def entry_frame(self, entry: TimelineEntry, local_t):
+        if entry.is_static(local_t):
+            # still frames are composited once and reused for the whole static part of the clip
+            if entry.static_frame is None:
+                entry.static_frame = self.compose(entry, local_t)
+            return entry.static_frame
+        return self.compose(entry, local_t)
+
+    def compose(self, entry: TimelineEntry, t):
+        clip = entry.clip
+        if clip.mask is None and tuple(clip.size) == tuple(self.size):
+            picture = clip.get_frame(t)
+        else:
+            # clips that are smaller than the frame or fading are drawn centered over black
+            picture = clip.blit_on(self.background, t)
+        for overlay in entry.overlays + self.overlays:
+            picture = overlay.blit_on(picture, t)
+        return picture
+
+    def clip(self):
+        return VideoClip(make_frame=self.get_frame, duration=self.duration)
+
+    # (frame, count) for each run of identical frames at the given frame rate. frames inside a static window are only composited once
+    def frame_runs(self, fps=30):
+        run_frame = None
+        run_entry = None
+        count = 0
+        for index in range(frame_count(self.duration, fps)):
+            t = index / fps
+            entry = self.entry(t)
+            if run_entry is entry and entry.is_static(t - entry.start):
+                count += 1
+                continue
+            if run_frame is not None:
+                yield (run_frame, count)
+            run_frame = self.get_frame(t)
+            run_entry = entry if entry.is_static(t - entry.start) else None
+            count = 1
+        if run_frame is not None:
+            yield (run_frame, count)
+
+
+# number of whole frames in a duration, as rendered. the epsilon absorbs float error in summed clip durations
+def frame_count(duration, fps) -> int:
+    return int(duration * fps + 1e-6)
+
+
+class ClipPlan:
+    def __init__(self, clip_format: ClipFormat, paths, duration):
+        self.clip_format = clip_format
+        self.paths = paths
+        self.duration = duration
+        self.asset_paths = clip_format.asset_paths(paths)
+
+
+class ScenePlan:
+    def __init__(self, scene: Scene, clips: List[ClipPlan], audio, duration):
+        self.scene = scene
+        self.clips = clips
+        self.audio = audio
+        self.duration = duration
+
 
 class Video:
-    def __init__(self, name, height=1280, width=720, scenes: List[Scene] = [], overlays: List[ImageClip] = [], background_audio: AudioFileClip = None):
+    def __init__(self, name, height=1280, width=720, scenes: List[Scene] = None, overlays: List[ImageClip] = None, background_audio: AudioFileClip = None):
+        if scenes is None:
+            scenes = []
+        if overlays is None:
+            overlays = []
         self.name = name
         self.height = height
         self.width = width
-        self.scenes = scenes
-        self.overlays = overlays
+        # size relative to the template the overlays were made for
+        self.scale = 1.0
+        # output sizes and encodings, all produced by one render. empty renders a single file at the video's own size
+        self.renditions = ()
+        self.scenes = tuple(scenes)
+        self.overlays = tuple(overlays)
         self.background_audio = background_audio
         self.assets = 0
         for scene in scenes:
             self.assets += scene.assets
 
+    def new(self):
+        return copy(self)
+
     def add_scene(self, scene):
-        self.scenes.append(scene)
-        return self
+        new = copy(self)
+        new.scenes = self.scenes + (scene,)
+        new.assets = self.assets + scene.assets
+        return new
+
+    def set_scene(self, index, scene: Scene):
+        new = copy(self)
+        scenes = list(self.scenes)
+        scenes[index] = scene
+        new.scenes = tuple(scenes)
+        return new
+
+    def set_scenes(self, scenes: List[Scene]):
+        new = copy(self)
+        new.scenes = tuple(scenes)
+        new.assets = sum(scene.assets for scene in scenes)
+        return new
+
+    def set_renditions(self, renditions: List[encoder.Rendition]):
+        new = copy(self)
+        new.renditions = tuple(renditions)
+        return new
+
+    def scaled(self, scale):
+        new = copy(self)
+        # encoders need even dimensions
+        new.height = int(round(self.height * scale / 2)) * 2
+        new.width = int(round(self.width * scale / 2)) * 2
+        new.scale = self.scale * scale
+        return new
 
     def set_background_audio(self, audio):
-        self.background_audio = audio
+        new = copy(self)
+        new.background_audio = audio
+        return new
 
-    # audio paths should be equal to num of scenes
-    def build(self, paths, audioclips):
+    # assign each scene its paths, audio and duration. audio paths should be equal to num of scenes
+    def plan(self, paths, audioclips):
         path_counter = 0
         audio_counter = 0
-        built_scenes: List[Scene] = []
+        scene_plans: List[ScenePlan] = []
 
-        # build each scene
+        # plan each scene
         for scene in self.scenes:
             # get audio if the scene requires it
             scene_audio = None
@@ -259,9 +544,9 @@ class Video:
             if paths_high_index > len(paths):
                 paths_high_index = len(paths)
 
-            # build the scene and add it to built scenes array
-            built_scenes.append(scene.build(
-                paths[path_counter: paths_high_index], scene_audio.duration, scene_audio, video_height=self.height, video_width=self.width))
+            scene_duration = scene_audio.duration
+            scene_plans.append(ScenePlan(scene, scene.plan(
+                paths[path_counter: paths_high_index], scene_duration), scene_audio, scene_duration))
 
             # increment paths counter to index of next available asset
             path_counter = path_counter + scene.assets
@@ -270,36 +555,273 @@ class Video:
             if path_counter > (len(paths) - 1):
                 path_counter = 0
 
-        # concatenate built scenes
+        return scene_plans
 
-        final_video = concatenate(built_scenes, method="compose")
+    def build(self, paths, audioclips):
+        # flatten every scene into one timeline
+        scene_plans = self.plan(paths, audioclips)
+        timeline = self.timeline(scene_plans)
+        final_video = timeline.clip()
+
+        # mix the narration and background music into one file up front, instead of chunk by chunk during the encode
+        if self.has_audio_files(scene_plans):
+            final_video.audio = AudioFileClip(
+                self.build_soundtrack(scene_plans), fps=soundtrack.SOUNDTRACK_FPS)
+        else:
+            final_video.audio = self.composite_audio(
+                scene_plans, timeline.duration)
 
-        # apply permanent video overlays
-        for overlay in self.overlays:
-            final_video = CompositeVideoClip(
-                [final_video, overlay.set_duration(final_video.duration)])
+        return final_video
 
+    def composite_audio(self, scene_plans, duration):
+        tracks = []
+        offset = 0
+        for scene_plan in scene_plans:
+            if scene_plan.audio is not None:
+                tracks.append(scene_plan.audio.set_start(offset))
+            offset += scene_plan.duration
         # apply background music if it exists
         if self.background_audio is not None:
-            final_audio = CompositeAudioClip(
-                [final_video.audio, self.background_audio.set_duration(final_video.duration)])
-            final_video.audio = final_audio
-
-        return final_video
+            tracks.append(self.background_audio.set_duration(duration))
+        return CompositeAudioClip(tracks)
+
+    def permanent_overlays(self) -> List[ImageClip]:
+        # still overlays are merged into a single layer so each frame is only blended once
+        overlays = overlay_clips(self.overlays, self.scale)
+        if len(overlays) > 1 and is_static(overlays[0], overlays[1:]):
+            overlays = [merge_overlays(overlays)]
+        return overlays
+
+    def timeline(self, scene_plans) -> Timeline:
+        timeline = Timeline((self.width, self.height),
+                            self.permanent_overlays())
+        for index, scene_plan in enumerate(scene_plans):
+            timeline.scene = index
+            with PROFILER.timed("scene_build", str(index)):
+                scene_plan.scene.add_to_timeline(
+                    timeline, scene_plan.clips, self.height, self.width, self.scale)
+        return timeline
+
+    def has_audio_files(self, scene_plans) -> bool:
+        audio = [scene_plan.audio for scene_plan in scene_plans if scene_plan.audio is not None]
+        if self.background_audio is not None:
+            audio.append(self.background_audio)
+        for clip in audio:
+            if getattr(clip, "filename", None) is None:
+                return False
+        return True
+
+    # with fps, each scene lasts a whole number of frames, as it does when scenes are rendered to separate segments
+    def build_soundtrack(self, scene_plans, fps=None) -> str:
+        narrations = []
+        for scene_plan in scene_plans:
+            path = None
+            if scene_plan.audio is not None:
+                path = scene_plan.audio.filename
+            duration = scene_plan.duration
+            if fps is not None:
+                duration = frame_count(duration, fps) / fps
+            narrations.append((path, duration))
+        background_path = None
+        if self.background_audio is not None:
+            background_path = self.background_audio.filename
+        return soundtrack.build_soundtrack(narrations, background_path, BACKGROUND_MUSIC_VOLUME)
+
+    # returns the paths of the files written
+    def render(self, paths, audioclips, output_path, fps=30, backend: RenderBackend = RENDER_BACKEND, preset="medium"):
+        if len(self.renditions) > 0:
+            self.render_renditions(
+                paths, audioclips, output_path, fps, backend, preset)
+            return [rendition.path(output_path) for rendition in self.renditions]
+        if backend == RenderBackend.FFMPEG:
+            if ffmpeg_render.supports(self):
+                ffmpeg_render.render_video(
+                    self, paths, audioclips, output_path, fps, preset)
+                return [output_path]
+            print("Video " + self.name +
+                  " cannot be rendered with ffmpeg. Falling back to MoviePy.")
+        elif backend == RenderBackend.PARALLEL:
+            if self.is_picklable():
+                self.render_parallel(
+                    paths, audioclips, output_path, fps, preset=preset)
+                return [output_path]
+            print("Video " + self.name +
+                  " has overlays that can't be sent to worker processes. Falling back to MoviePy.")
+        self.encode(paths, audioclips, output_path, fps, preset)
+        return [output_path]
+
+    def render_renditions(self, paths, audioclips, output_path, fps=30, backend: RenderBackend = RENDER_BACKEND, preset="medium"):
+        # composite once at the size of the largest rendition, and scale it down to the others inside the encoder
+        master = encoder.master_rendition(self.renditions)
+        master_video = self.scaled(master.height / self.height)
+        if backend == RenderBackend.FFMPEG:
+            if ffmpeg_render.supports(self):
+                ffmpeg_render.render_video(
+                    master_video, paths, audioclips, output_path, fps, preset, self.renditions)
+                return
+            print("Video " + self.name +
+                  " cannot be rendered with ffmpeg. Falling back to MoviePy.")
+        elif backend == RenderBackend.PARALLEL:
+            print("Renditions are rendered in a single pass. Rendering " +
+                  self.name + " with MoviePy.")
+        master_video.encode(paths, audioclips, output_path,
+                            fps, preset, self.renditions)
+
+    # composite the timeline with MoviePy and encode it with ffmpeg, to the video's own size unless renditions are given
+    def encode(self, paths, audioclips, output_path, fps=30, preset="medium", renditions=None):
+        if not renditions:
+            renditions = [encoder.Rendition(None, self.height, self.width)]
+        scene_plans = self.plan(paths, audioclips)
+        with PROFILER.stage("timeline"):
+            timeline = self.timeline(scene_plans)
+        temp_audio_path = None
+        with PROFILER.stage("soundtrack"):
+            if self.has_audio_files(scene_plans):
+                audio_path = self.build_soundtrack(scene_plans)
+            else:
+                audio_path = temp_audio_path = output_path + ".wav"
+                self.composite_audio(scene_plans, timeline.duration).write_audiofile(
+                    audio_path, fps=soundtrack.SOUNDTRACK_FPS, logger=None)
+        try:
+            encoder.write_renditions(
+                timeline, audio_path, renditions, output_path, fps, preset)
+        finally:
+            if temp_audio_path is not None:
+                os.remove(temp_audio_path)
+
+    # scenes are sent to worker processes without the background audio, which needs every overlay to be a file backed Overlay
+    def is_picklable(self) -> bool:
+        overlays = list(self.overlays)
+        for scene in self.scenes:
+            overlays += scene.overlays
+            for clip_format in scene.clip_formats:
+                overlays += clip_format.overlays
+        return all(isinstance(overlay, Overlay) for overlay in overlays)
+
+    # hash of everything that determines how a scene's segment looks
+    def scene_key(self, scene_plan: ScenePlan, fps=30, preset="medium") -> str:
+        description = [self.width, self.height,
+                       self.scale, fps, preset, scene_plan.duration]
+        if scene_plan.audio is not None:
+            description.append(file_hash(scene_plan.audio.filename))
+        description.append([overlay_hash(overlay) for overlay in self.overlays])
+        description.append([overlay_hash(overlay)
+                           for overlay in scene_plan.scene.overlays])
+        for clip_plan in scene_plan.clips:
+            clip_format = clip_plan.clip_format
+            description.append([clip_format.style.name, clip_format.size.name, clip_format.assets, clip_plan.duration,
+                                [transition.name for transition in clip_format.transitions],
+                                [overlay_hash(overlay)
+                                 for overlay in clip_format.overlays],
+                                [file_hash(path) for path in clip_plan.asset_paths]])
+        return hashlib.sha1(repr(description).encode()).hexdigest()
+
+    def render_parallel(self, paths, audioclips, output_path, fps=30, workers=RENDER_WORKERS, preset="medium"):
+        scene_plans = self.plan(paths, audioclips)
+        segment_paths = []
+        pending = {}
+        # render each scene to a silent segment, unless an identical scene is already cached. transitions live inside each clip, so scene boundaries need no overlap
+        with PROFILER.stage("segments"), ProcessPoolExecutor(max_workers=workers) as executor:
+            for index, scene_plan in enumerate(scene_plans):
+                segment_path = SEGMENT_CACHE_PATH + \
+                    self.scene_key(scene_plan, fps, preset) + ".mp4"
+                segment_paths.append(segment_path)
+                if os.path.exists(segment_path):
+                    print("Scene " + str(index) + " is unchanged, reusing " + segment_path)
+                    continue
+                if segment_path in pending:
+                    continue
+                # render to a temporary file so an interrupted render is never mistaken for a cached segment
+                temp_path = segment_path[:-len(".mp4")] + \
+                    "." + str(os.getpid()) + ".tmp.mp4"
+                # segments are silent, and the background music clip holds a reader process that can't be pickled
+                segment_video = self.set_scenes(
+                    [scene_plan.scene]).set_background_audio(None)
+                pending[segment_path] = (temp_path, executor.submit(render_scene_segment, segment_video, [clip_plan.asset_paths for clip_plan in scene_plan.clips], [
+                    clip_plan.duration for clip_plan in scene_plan.clips], temp_path, fps, preset))
+            for segment_path, (temp_path, future) in pending.items():
+                future.result()
+                os.replace(temp_path, segment_path)
+        print("Rendered " + str(len(pending)) + " of " +
+              str(len(scene_plans)) + " scenes.")
+        # join the segments with a stream copy and mix the narration and background music in at the end
+        with PROFILER.stage("join"):
+            ffmpeg_render.concat_segments(
+                self, scene_plans, segment_paths, output_path, fps)
+
+
+def render_scene_segment(video_template: Video, clip_paths, clip_durations, output_path, fps=30, preset="medium"):
+    # runs in a worker process. the video only holds the scene to render and the permanent overlays
+    scene = video_template.scenes[0]
+    clip_plans = []
+    for clip_format, paths, duration in zip(scene.clip_formats, clip_paths, clip_durations):
+        clip_plans.append(ClipPlan(clip_format, paths, duration))
+    timeline = video_template.timeline(
+        [ScenePlan(scene, clip_plans, None, sum(clip_durations))])
+    encoder.write_renditions(timeline, None, [encoder.Rendition(
+        None, video_template.height, video_template.width)], output_path, fps, preset)
+
+
+def overlay_hash(overlay) -> str:
+    if getattr(overlay, "filename", None) is not None:
+        return file_hash(overlay.filename)
+    return hashlib.sha1(overlay_clips([overlay])[0].get_frame(0).tobytes()).hexdigest()
+
+
+# loaded overlay images by path, shared by every template and every copy of one
+OVERLAY_CLIPS = {}
+
+
+class Overlay:
+    # an overlay image that is only loaded the first time a video is built with it
+    def __init__(self, path):
+        self.filename = path
+
+    def clip(self, scale=1.0):
+        key = (self.filename, scale)
+        if key not in OVERLAY_CLIPS:
+            clip = ImageClip(self.filename)
+            if scale != 1.0:
+                clip = clip.resize(scale)
+            OVERLAY_CLIPS[key] = clip
+        return OVERLAY_CLIPS[key]
+
+
+def overlay_clips(overlays, scale=1.0) -> List[ImageClip]:
+    clips = []
+    for overlay in overlays:
+        if isinstance(overlay, Overlay):
+            overlay = overlay.clip(scale)
+        elif scale != 1.0:
+            overlay = overlay.resize(scale)
+        clips.append(overlay)
+    return clips
+
+
+def load_overlay(path):
+    return Overlay(path)
+
+
+def merge_overlays(overlays: List[ImageClip]):
+    # merge still overlays into one transparent ImageClip
+    merged = CompositeVideoClip(list(overlays))
+    frame = merged.get_frame(0)
+    mask = merged.mask.get_frame(0)
+    return ImageClip(frame).set_mask(ImageClip(mask, ismask=True))
 
 
 # region Overlays
 
-OVERLAY_VS_PERM = ImageClip("Overlays/Permanent.png")
-OVERLAY_VS_INTRO = ImageClip("Overlays/VS.png")
-OVERLAY_VS_INTRO2 = ImageClip("Overlays/Size.png")
-OVERLAY_VS_SPEED = ImageClip("Overlays/Speed.png")
-OVERLAY_VS_BITE = ImageClip("Overlays/Bite.png")
-OVERLAY_VS_DUR = ImageClip("Overlays/Durability.png")
-OVERLAY_VS_LETH = ImageClip("Overlays/Lethality.png")
-OVERLAY_VS_WINNER = ImageClip("Overlays/Winner.png")
+OVERLAY_VS_PERM = load_overlay("Overlays/Permanent.png")
+OVERLAY_VS_INTRO = load_overlay("Overlays/VS.png")
+OVERLAY_VS_INTRO2 = load_overlay("Overlays/Size.png")
+OVERLAY_VS_SPEED = load_overlay("Overlays/Speed.png")
+OVERLAY_VS_BITE = load_overlay("Overlays/Bite.png")
+OVERLAY_VS_DUR = load_overlay("Overlays/Durability.png")
+OVERLAY_VS_LETH = load_overlay("Overlays/Lethality.png")
+OVERLAY_VS_WINNER = load_overlay("Overlays/Winner.png")
 
-OVERLAY_5_FACTS = ImageClip("Overlays/5Facts.png")
+OVERLAY_5_FACTS = load_overlay("Overlays/5Facts.png")
 # endregion
 
 # region Clip Formats
@@ -361,35 +883,57 @@ def choose_background_music():
     filename = random.choice(files)
     background_audio = AudioFileClip(
         BACKGROUND_MUSIC_PATH + filename, fps=44100)
-    background_audio = background_audio.fx(afx.volumex, 0.10)
+    background_audio = background_audio.fx(
+        afx.volumex, BACKGROUND_MUSIC_VOLUME)
 
     return background_audio
 
 
-def gen_animal_facts_video(animal: Animal):
-    animalpath = ASSET_PATH + animal.name + "/" + ACTIVE_PATH
+# paths of the animal's active images from its asset index. falls back to the numbered files in Active/ if the index has none
+def active_asset_paths(animal: Animal, count=8):
+    paths = asset_index.get_active_paths(ASSET_PATH, animal.name)
+    if len(paths) == 0:
+        paths = [ASSET_PATH + animal.name + "/" + ACTIVE_PATH +
+                 str(i) + ".jpg" for i in range(count)]
+    # reuse images if there are fewer active ones than the video needs
+    while len(paths) < count:
+        paths = paths + paths[:count - len(paths)]
+    return paths
+
+
+# previews are written next to the final video instead of replacing it
+def output_name(name, quality: RenderQuality) -> str:
+    if quality.name == FINAL_QUALITY.name:
+        return name + ".mp4"
+    return name + "_" + quality.name + ".mp4"
+
+
+def gen_animal_facts_video(animal: Animal, backend: RenderBackend = RENDER_BACKEND, quality: RenderQuality = FINAL_QUALITY, renditions: List[encoder.Rendition] = None):
     audiopath = script.get_script_audio_path(
         script.ScriptType.FIVE_FACTS, [animal])
     paths = []
     audio_clips = []
+    active_paths = active_asset_paths(animal)
     for i in range(6):
         audio_clip = AudioFileClip(
             audiopath + str(i) + ".wav")
         audio_clips.append(audio_clip)
-        paths.append(animalpath + str(i) + ".jpg")
-    fact_vid = FACTS_VIDEO
+        paths.append(active_paths[i])
+    fact_vid = FACTS_VIDEO.scaled(quality.scale)
+    if renditions:
+        fact_vid = fact_vid.set_renditions(renditions)
     if len(os.listdir(BACKGROUND_MUSIC_PATH)) > 0:
         background_music = choose_background_music()
-        fact_vid.set_background_audio(background_music)
-    export = fact_vid.build(paths, audio_clips)
-    export.write_videofile(VIDEO_OUTPUT_PATH +
-                           fact_vid.name + "_" + animal.name + ".mp4", fps=30)
+        fact_vid = fact_vid.set_background_audio(background_music)
+    return fact_vid.render(paths, audio_clips, VIDEO_OUTPUT_PATH + output_name(fact_vid.name + "_" + animal.name, quality),
+                           fps=quality.fps, backend=backend, preset=quality.preset)
 
 
-def gen_animal_vs_video(animal1: Animal, animal2: Animal, winner: Animal):
-    animal1path = ASSET_PATH + animal1.name + "/" + ACTIVE_PATH
-    animal2path = ASSET_PATH + animal2.name + "/" + ACTIVE_PATH
-    winnerpath = winner.name + "/"
+def gen_animal_vs_video(animal1: Animal, animal2: Animal, winner: Animal, backend: RenderBackend = RENDER_BACKEND, quality: RenderQuality = FINAL_QUALITY, renditions: List[encoder.Rendition] = None):
+    animal1_paths = active_asset_paths(animal1)
+    animal2_paths = active_asset_paths(animal2)
+    # the last active image of the winner is shown alone in the final scene
+    winner_path = active_asset_paths(winner)[7]
     audiopath = script.get_script_audio_path(
         script.ScriptType.VERSUS, [animal1, animal2])
     paths = []
@@ -398,14 +942,16 @@ def gen_animal_vs_video(animal1: Animal, animal2: Animal, winner: Animal):
         audio_clip = AudioFileClip(
             audiopath + str(i) + ".wav")
         audio_clips.append(audio_clip)
-        paths.append(animal1path + str(i) + ".jpg")
-        paths.append(animal2path + str(i) + ".jpg")
-    vs_video = ANIMAL_VERSUS_VIDEO
-    vs_video.scenes[7].clip_formats[1].set_override(
-        winnerpath + "7" + ".jpg")
+        paths.append(animal1_paths[i])
+        paths.append(animal2_paths[i])
+    # per video state goes on a copy of the template, which shares everything else with it
+    final_scene = ANIMAL_VERSUS_VIDEO.scenes[7]
+    vs_video = ANIMAL_VERSUS_VIDEO.set_scene(7, final_scene.set_clip_format(
+        1, final_scene.clip_formats[1].set_override(winner_path))).scaled(quality.scale)
+    if renditions:
+        vs_video = vs_video.set_renditions(renditions)
     if len(os.listdir(BACKGROUND_MUSIC_PATH)) > 0:
         background_music = choose_background_music()
-        vs_video.set_background_audio(background_music)
-    export_video = vs_video.build(paths, audio_clips)
-    export_video.write_videofile(VIDEO_OUTPUT_PATH +
-                                 vs_video.name + "_" + animal1.name + "_" + animal2.name + ".mp4", fps=30)
+        vs_video = vs_video.set_background_audio(background_music)
+    return vs_video.render(paths, audio_clips, VIDEO_OUTPUT_PATH + output_name(vs_video.name + "_" + animal1.name + "_" + animal2.name, quality),
+                           fps=quality.fps, backend=backend, preset=quality.preset)